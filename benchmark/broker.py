@@ -0,0 +1,227 @@
+# Minimal MQTT 3.1.1 broker for benchmarks and local testing.
+# Supports QoS 0/1, retained messages and +/# wildcards, no authentication or persistence.
+
+import asyncio
+import logging
+import struct
+
+log = logging.getLogger("Broker")
+
+CONNECT = 1
+CONNACK = 2
+PUBLISH = 3
+PUBACK = 4
+SUBSCRIBE = 8
+SUBACK = 9
+UNSUBSCRIBE = 10
+UNSUBACK = 11
+PINGREQ = 12
+PINGRESP = 13
+DISCONNECT = 14
+
+
+def matches(topic_filter, topic):
+    """ Returns True if a topic matches a subscription filter according to the MQTT spec """
+    if topic_filter == topic:
+        return True
+    if topic[:1] == "$" and topic_filter[:1] in ("+", "#"):
+        return False
+    flevels = topic_filter.split("/")
+    tlevels = topic.split("/")
+    for i, flevel in enumerate(flevels):
+        if flevel == "#":
+            return True
+        if i >= len(tlevels):
+            return False
+        if flevel != "+" and flevel != tlevels[i]:
+            return False
+    return len(flevels) == len(tlevels)
+
+
+def encodeLength(length):
+    data = bytearray()
+    while True:
+        byte = length % 128
+        length //= 128
+        if length > 0:
+            byte |= 0x80
+        data.append(byte)
+        if length == 0:
+            return bytes(data)
+
+
+def encodeString(s):
+    if type(s) == str:
+        s = s.encode()
+    return struct.pack("!H", len(s)) + s
+
+
+def packet(ptype, flags, body=b""):
+    return bytes(((ptype << 4) | flags,)) + encodeLength(len(body)) + body
+
+
+def publishPacket(topic, payload, qos=0, retain=False, pid=0):
+    body = encodeString(topic)
+    if qos > 0:
+        body += struct.pack("!H", pid)
+    return packet(PUBLISH, (qos << 1) | int(retain), body + payload)
+
+
+async def readPacket(reader):
+    """ Returns (type, flags, body) of the next packet """
+    header = await reader.readexactly(1)
+    length = 0
+    multiplier = 1
+    while True:
+        byte = (await reader.readexactly(1))[0]
+        length += (byte & 0x7F) * multiplier
+        if byte & 0x80 == 0:
+            break
+        multiplier *= 128
+    body = await reader.readexactly(length) if length else b""
+    return header[0] >> 4, header[0] & 0x0F, body
+
+
+def parsePublish(flags, body):
+    """ Returns (topic, payload, qos, retain, pid) """
+    tlen = struct.unpack_from("!H", body)[0]
+    topic = body[2:2 + tlen].decode()
+    pos = 2 + tlen
+    qos = (flags >> 1) & 0x03
+    pid = 0
+    if qos > 0:
+        pid = struct.unpack_from("!H", body, pos)[0]
+        pos += 2
+    return topic, body[pos:], qos, bool(flags & 0x01), pid
+
+
+class _Session:
+    def __init__(self, broker, writer):
+        self.broker = broker
+        self.writer = writer
+        self.client_id = None
+        self.filters = {}
+        self.task = asyncio.current_task()
+        self._pid = 0
+
+    def send(self, topic, payload, qos, retain=False):
+        pid = 0
+        if qos > 0:
+            self._pid = self._pid % 65535 + 1
+            pid = self._pid
+        self.writer.write(publishPacket(topic, payload, qos, retain, pid))
+
+
+class Broker:
+    def __init__(self, host="127.0.0.1", port=0):
+        self.host = host
+        self.port = port
+        self._server = None
+        self._sessions = set()
+        self._exact = {}  # topic: set of sessions subscribed without wildcard
+        self._wildcards = {}  # topic filter: set of sessions
+        self._retained = {}
+        self.messages = 0
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        log.info("Broker listening on {!s}:{!s}".format(self.host, self.port))
+        return self
+
+    async def stop(self):
+        self._server.close()
+        for session in list(self._sessions):
+            session.writer.close()
+        await asyncio.gather(*[session.task for session in self._sessions], return_exceptions=True)
+        await self._server.wait_closed()
+
+    def isSubscribed(self, topic_filter):
+        return topic_filter in self._exact or topic_filter in self._wildcards
+
+    def hasRetained(self, topic):
+        return topic in self._retained
+
+    def _subscribe(self, session, topic_filter, qos):
+        session.filters[topic_filter] = qos
+        index = self._wildcards if ("+" in topic_filter or "#" in topic_filter) else self._exact
+        index.setdefault(topic_filter, set()).add(session)
+        for topic, (payload, rqos) in self._retained.items():
+            if matches(topic_filter, topic):
+                session.send(topic, payload, min(qos, rqos), retain=True)
+
+    def _unsubscribe(self, session, topic_filter):
+        session.filters.pop(topic_filter, None)
+        for index in (self._exact, self._wildcards):
+            sessions = index.get(topic_filter)
+            if sessions is not None:
+                sessions.discard(session)
+                if len(sessions) == 0:
+                    del index[topic_filter]
+
+    def _publish(self, topic, payload, qos, retain):
+        self.messages += 1
+        if retain:
+            if len(payload) == 0:
+                self._retained.pop(topic, None)
+            else:
+                self._retained[topic] = (payload, qos)
+        receivers = {}
+        for session in self._exact.get(topic, ()):
+            receivers[session] = session.filters.get(topic, 0)
+        for topic_filter, sessions in self._wildcards.items():
+            if matches(topic_filter, topic):
+                for session in sessions:
+                    receivers[session] = max(receivers.get(session, 0), session.filters[topic_filter])
+        for session, sqos in receivers.items():
+            session.send(topic, payload, min(qos, sqos))
+
+    async def _handle(self, reader, writer):
+        session = _Session(self, writer)
+        self._sessions.add(session)
+        try:
+            while True:
+                ptype, flags, body = await readPacket(reader)
+                if ptype == CONNECT:
+                    plen = struct.unpack_from("!H", body)[0]
+                    pos = 2 + plen + 4  # protocol level, connect flags, keepalive
+                    clen = struct.unpack_from("!H", body, pos)[0]
+                    session.client_id = body[pos + 2:pos + 2 + clen].decode()
+                    writer.write(packet(CONNACK, 0, b"\x00\x00"))
+                elif ptype == PUBLISH:
+                    topic, payload, qos, retain, pid = parsePublish(flags, body)
+                    if qos > 0:
+                        writer.write(packet(PUBACK, 0, struct.pack("!H", pid)))
+                    self._publish(topic, payload, qos, retain)
+                elif ptype == SUBSCRIBE:
+                    pid = body[:2]
+                    pos = 2
+                    granted = bytearray()
+                    while pos < len(body):
+                        flen = struct.unpack_from("!H", body, pos)[0]
+                        topic_filter = body[pos + 2:pos + 2 + flen].decode()
+                        qos = min(body[pos + 2 + flen], 1)
+                        pos += 3 + flen
+                        granted.append(qos)
+                        self._subscribe(session, topic_filter, qos)
+                    writer.write(packet(SUBACK, 0, pid + bytes(granted)))
+                elif ptype == UNSUBSCRIBE:
+                    pos = 2
+                    while pos < len(body):
+                        flen = struct.unpack_from("!H", body, pos)[0]
+                        self._unsubscribe(session, body[pos + 2:pos + 2 + flen].decode())
+                        pos += 2 + flen
+                    writer.write(packet(UNSUBACK, 0, body[:2]))
+                elif ptype == PINGREQ:
+                    writer.write(packet(PINGRESP, 0))
+                elif ptype == DISCONNECT:
+                    break
+                # PUBACKs of clients are ignored, messages are not redelivered
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            for topic_filter in list(session.filters):
+                self._unsubscribe(session, topic_filter)
+            self._sessions.discard(session)
+            writer.close()
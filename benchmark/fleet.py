@@ -0,0 +1,92 @@
+# Synthetic devices behaving like pysmartnode nodes: they request their config
+# on home/login/<id>/set and publish log messages to home/log/<level>/<id>.
+
+import asyncio
+import json
+import os
+import struct
+import time
+
+from benchmark.broker import readPacket, packet, encodeString, publishPacket, parsePublish
+from benchmark.broker import CONNECT, CONNACK, PUBLISH, PUBACK, SUBSCRIBE, SUBACK
+
+
+class Device:
+    def __init__(self, device_id, home="home"):
+        self.id = device_id
+        self.home = home
+        self._reader = None
+        self._writer = None
+        self._task = None
+        self._inbox = asyncio.Queue()
+        self._pid = 0
+
+    async def connect(self, host, port):
+        self._reader, self._writer = await asyncio.open_connection(host, port)
+        # MQTT 3.1.1, clean session, keepalive 60s
+        self._writer.write(packet(CONNECT, 0, encodeString("MQTT") + b"\x04\x02\x00\x3c" + encodeString(self.id)))
+        ptype, flags, body = await readPacket(self._reader)
+        if ptype != CONNACK:
+            raise ConnectionError("No CONNACK for {!s}".format(self.id))
+        self._writer.write(packet(SUBSCRIBE, 2, struct.pack("!H", self._nextPid()) +
+                                  encodeString("{!s}/login/{!s}/#".format(self.home, self.id)) + b"\x01"))
+        ptype, flags, body = await readPacket(self._reader)
+        if ptype != SUBACK:
+            raise ConnectionError("No SUBACK for {!s}".format(self.id))
+        self._task = asyncio.ensure_future(self._receive())
+
+    def _nextPid(self):
+        self._pid = self._pid % 65535 + 1
+        return self._pid
+
+    async def _receive(self):
+        try:
+            while True:
+                ptype, flags, body = await readPacket(self._reader)
+                if ptype != PUBLISH:
+                    continue
+                topic, payload, qos, retain, pid = parsePublish(flags, body)
+                if qos > 0:
+                    self._writer.write(packet(PUBACK, 0, struct.pack("!H", pid)))
+                if topic.endswith("/set"):
+                    continue  # own config request
+                self._inbox.put_nowait((topic, payload))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+
+    def publish(self, topic, payload, qos=0):
+        pid = self._nextPid() if qos else 0
+        self._writer.write(publishPacket(topic, payload.encode(), qos, pid=pid))
+
+    def log(self, level, message):
+        self.publish("{!s}/log/{!s}/{!s}".format(self.home, level, self.id), message)
+
+    async def requestConfig(self, platform="esp8266", wait=0, timeout=60):
+        """ Requests the config and returns the seconds until it was received completely """
+        start = time.perf_counter()
+        payload = ["1.0.0", platform, wait] if platform else "1.0.0"
+        self.publish("{!s}/login/{!s}/set".format(self.home, self.id), json.dumps(payload), qos=1)
+        topic, msg = await asyncio.wait_for(self._inbox.get(), timeout)
+        if platform:
+            for i in range(int(msg)):
+                await asyncio.wait_for(self._inbox.get(), timeout)
+        return time.perf_counter() - start
+
+    async def drain(self):
+        await self._writer.drain()
+
+    async def close(self):
+        self._writer.close()
+        if self._task is not None:
+            await asyncio.gather(self._task, return_exceptions=True)
+
+
+def createConfigs(path, device_ids, components=10, component_size=200):
+    """ Creates a config directory with json components for every device """
+    for device in device_ids:
+        config_dir = os.path.join(path, "Clients", device, "config")
+        os.makedirs(config_dir, exist_ok=True)
+        for i in range(components):
+            with open(os.path.join(config_dir, "component{:02d}.json".format(i)), "w") as f:
+                json.dump({"component": "sensor{!s}".format(i), "pin": i,
+                           "description": "x" * component_size}, f)
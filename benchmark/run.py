@@ -0,0 +1,218 @@
+# Benchmark of SmartServer against a local in-process broker and a synthetic device fleet.
+# The server runs as subprocess in a temporary directory with generated device configs.
+#
+# python -m benchmark.run --devices 500 --logs 100
+
+import argparse
+import asyncio
+import glob
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmark.broker import Broker
+from benchmark.fleet import Device, createConfigs
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HOME = "home"
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def _stat(pid):
+    with open("/proc/{!s}/stat".format(pid)) as f:
+        return f.read().rsplit(")", 1)[1].split()
+
+
+class _Process:
+    """ CPU time and memory of the server process and its children (shards, config parsers) read from /proc (Linux only) """
+
+    def __init__(self, pid):
+        self.pid = pid
+
+    def _pids(self):
+        pids = [self.pid]
+        for pid in os.listdir("/proc"):
+            try:
+                if pid.isdigit() and int(_stat(pid)[1]) == self.pid:
+                    pids.append(int(pid))
+            except (OSError, ValueError, IndexError):
+                pass
+        return pids
+
+    def cpu(self):
+        total = None
+        for pid in self._pids():
+            try:
+                fields = _stat(pid)
+            except (OSError, ValueError):
+                continue
+            total = (total or 0) + (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+        return total
+
+    def memory(self):
+        """ Returns current and peak RSS in MB """
+        mem = {}
+        for pid in self._pids():
+            try:
+                with open("/proc/{!s}/status".format(pid)) as f:
+                    for line in f:
+                        if line.startswith("VmRSS:") or line.startswith("VmHWM:"):
+                            mem[line[:5]] = mem.get(line[:5], 0) + int(line.split()[1]) / 1024
+            except OSError:
+                pass
+        return mem.get("VmRSS"), mem.get("VmHWM")
+
+
+def _prepare(path, port, args, device_ids):
+    shutil.copy(os.path.join(ROOT, "main.py"), path)
+    shutil.copytree(os.path.join(ROOT, "utils"), os.path.join(path, "utils"),
+                    ignore=shutil.ignore_patterns("__pycache__"))
+    with open(os.path.join(ROOT, "config_example.py"), encoding="iso-8859-15") as f:
+        conf = f.read()
+    conf += "\n# benchmark\nMQTT_HOST = \"127.0.0.1\"\nMQTT_PORT = {!s}\nMQTT_HOME = \"{!s}\"\n".format(port, HOME)
+    conf += "LOG_RATE_LIMIT = {!r}\nMQTT_QUEUE_SIZE = {!s}\n".format(args.log_rate_limit, args.queue_size)
+    conf += "SHARDS = {!s}\n".format(args.shards)
+    with open(os.path.join(path, "config.py"), "w", encoding="iso-8859-15") as f:
+        f.write(conf)
+    createConfigs(path, device_ids, args.components, args.component_size)
+
+
+def _report(name, elapsed, process, cpu_start, lines):
+    print("\n== {!s} ({:.2f}s)".format(name, elapsed))
+    for line in lines:
+        print("  " + line)
+    # broker and fleet share one process, if it is close to 100% the results are limited by the benchmark
+    print("  broker+fleet cpu: {:.0%} of one core".format((time.process_time() - cpu_start[1]) / elapsed))
+    cpu_start = cpu_start[0]
+    cpu = process.cpu()
+    if cpu is not None and cpu_start is not None:
+        print("  server cpu: {:.2f}s ({:.0%} of one core)".format(cpu - cpu_start, (cpu - cpu_start) / elapsed))
+    rss, peak = process.memory()
+    if rss is not None:
+        print("  server rss: {:.1f} MB (peak {:.1f} MB)".format(rss, peak))
+
+
+async def _configStorm(devices, args, process):
+    cpu = process.cpu(), time.process_time()
+    start = time.perf_counter()
+    results = await asyncio.gather(*[d.requestConfig(args.platform, args.wait, args.timeout) for d in devices],
+                                   return_exceptions=True)
+    elapsed = time.perf_counter() - start
+    latencies = [r for r in results if type(r) == float]
+    lines = ["requests: {!s}, failed: {!s}".format(len(results), len(results) - len(latencies))]
+    if latencies:
+        lines.append("latency p50 {:.1f}ms, p90 {:.1f}ms, p99 {:.1f}ms, max {:.1f}ms".format(
+            *[percentile(latencies, p) * 1000 for p in (50, 90, 99, 100)]))
+    _report("config requests, {!s} devices at once".format(len(devices)), elapsed, process, cpu, lines)
+
+
+async def _logFlood(devices, args, process, path):
+    async def flood(device):
+        for i in range(args.logs):
+            device.log(random.choice(("info", "warn", "error")), "benchmark message {!s} of {!s}".format(i, device.id))
+            if i % 50 == 0:
+                await device.drain()
+        await device.drain()
+        # messages of a device are processed in order, so the config answer arrives after all logs
+        return await device.requestConfig(args.platform, args.wait, args.timeout)
+
+    cpu = process.cpu(), time.process_time()
+    start = time.perf_counter()
+    results = await asyncio.gather(*[flood(d) for d in devices], return_exceptions=True)
+    elapsed = time.perf_counter() - start
+    sent = len(devices) * args.logs
+    await asyncio.sleep(2)  # let the log writer flush
+    written = 0
+    for file in glob.glob(os.path.join(path, "Clients", "*", "*.log")):
+        with open(file, "rb") as f:
+            written += sum(1 for line in f if b"benchmark message" in line)
+    failed = len([r for r in results if type(r) != float])
+    lines = ["log messages sent: {!s}, written: {!s}, sequences not completed: {!s}".format(sent, written, failed),
+             "throughput: {:.0f} messages/s".format(sent / elapsed)]
+    _report("log flood, {!s} messages per device".format(args.logs), elapsed, process, cpu, lines)
+
+
+def _routing(args):
+    sys.path.insert(0, ROOT)
+    from utils.topics import TopicMatcher
+    matcher = TopicMatcher()
+    matcher.add("{!s}/login/#".format(HOME), "login")
+    matcher.add("{!s}/log/#".format(HOME), "log")
+    for i in range(100):
+        matcher.add("{!s}/device{!s}/state/set".format(HOME, i), "state")
+    topics = ["{!s}/log/{!s}/device{!s}".format(HOME, level, i) for i in range(args.devices)
+              for level in ("info", "warn", "error")]
+    n = 200000
+    start = time.perf_counter()
+    for i in range(n):
+        matcher.match(topics[i % len(topics)])
+    elapsed = time.perf_counter() - start
+    print("\n== topic routing\n  {!s} distinct topics: {:.0f} matches/s".format(len(topics), n / elapsed))
+
+
+async def main(args):
+    broker = await Broker(port=args.port).start()
+    path = tempfile.mkdtemp(prefix="smartserver-bench-")
+    device_ids = ["bench{:04d}".format(i) for i in range(args.devices)]
+    _prepare(path, broker.port, args, device_ids)
+    server = subprocess.Popen([sys.executable, "main.py"], cwd=path,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    devices = []
+    try:
+        shard_stats = ["{!s}/SmartServer/shard{!s}/stats".format(HOME, i) for i in range(args.shards)]
+        for i in range(100):
+            if broker.isSubscribed("{!s}/log/#".format(HOME)) and all(broker.hasRetained(t) for t in shard_stats):
+                break
+            if server.poll() is not None:
+                raise RuntimeError("Server stopped with code {!s}".format(server.returncode))
+            await asyncio.sleep(0.1)
+        else:
+            raise RuntimeError("Server did not subscribe")
+        process = _Process(server.pid)
+        devices = [Device(device_id, HOME) for device_id in device_ids]
+        await asyncio.gather(*[d.connect("127.0.0.1", broker.port) for d in devices])
+        print("SmartServer benchmark: {!s} devices, {!s} components of {!s} bytes, working dir {!s}".format(
+            args.devices, args.components, args.component_size, path))
+        await _configStorm(devices, args, process)  # cold, configs are loaded from disk
+        await _configStorm(devices, args, process)  # warm, configs are cached
+        if args.logs:
+            await _logFlood(devices, args, process, path)
+        _routing(args)
+    finally:
+        for device in devices:
+            await device.close()
+        server.terminate()
+        server.wait()
+        await broker.stop()
+        if not args.keep:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def _parseArgs():
+    parser = argparse.ArgumentParser(description="SmartServer benchmark with a local broker")
+    parser.add_argument("--devices", type=int, default=100)
+    parser.add_argument("--components", type=int, default=10, help="config components per device")
+    parser.add_argument("--component-size", type=int, default=200, help="bytes of filler per component")
+    parser.add_argument("--logs", type=int, default=100, help="log messages per device, 0 to skip")
+    parser.add_argument("--platform", default="esp8266", help="platform sent in the config request, "
+                                                              "empty for whole config delivery")
+    parser.add_argument("--wait", type=float, default=0, help="wait between components requested by devices")
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--log-rate-limit", type=float, default=None)
+    parser.add_argument("--queue-size", type=int, default=100000)
+    parser.add_argument("--shards", type=int, default=0, help="worker processes of the server, 0 for one process")
+    parser.add_argument("--port", type=int, default=0, help="broker port, random if 0")
+    parser.add_argument("--keep", action="store_true", help="keep the working directory")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    asyncio.run(main(_parseArgs()))
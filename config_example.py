@@ -11,12 +11,58 @@ Logging
 LOG_FOLDER = "Logs/"
 LOG_FILENAME = 'smartServer.log'
 LOGGER_NAME = ""  # empty logger name lets every sub-logger log to main file
+LOG_CONSOLE_LEVEL = "DEBUG"  # e.g. "INFO" to skip debug messages of the server, log files get INFO and above
+LOG_RATE_LIMIT = 20  # log messages per second accepted for each device and level, None to disable
+LOG_RATE_BURST = 100  # log messages a device can send at once before the rate limit applies
+LOG_DEDUP_WINDOW = 60  # seconds in which repeats of a device's log message are only counted, None to write every message
+LOG_DEDUP_SIZE = 8  # recent log messages per device checked for repeats
+LOG_BUFFER_SIZE = 64 * 1024  # bytes of log records buffered per log file before they are written
+LOG_FLUSH_INTERVAL = 1  # seconds until buffered log records are written, critical records are written immediately
+LOG_MAX_BYTES = 1024 * 1024  # log files are rotated when they get bigger, 0 to disable
+LOG_ROTATE_WHEN = "midnight"  # log files are also rotated at midnight or every n seconds, None to disable
+LOG_COMPRESSION = "gzip"  # compression of rotated log files: "gzip", "zstd" (needs zstandard) or None
+LOG_BACKUP_COUNT = 100  # rotated log files kept per log file, 0 for no limit
+LOG_RETENTION_DAYS = 30  # rotated log files older than this are removed, None to keep them
+LOG_DB = None  # e.g. "Logs/devices.db" to also store all device log messages in a queryable SQLite database
+LOG_DB_RETENTION = 30  # days log messages are kept in LOG_DB, None to keep all
 
 
 """
 MQTT
 """
 MQTT_HOST = "localhost"
+MQTT_PORT = 1883
 MQTT_USER = ""
 MQTT_PASSWORD = ""
 MQTT_HOME = "home"
+MQTT_WORKERS = 16  # incoming messages processed concurrently
+MQTT_QUEUE_SIZE = 1000  # incoming messages waiting for a worker, further messages get dropped
+
+
+"""
+Clients
+"""
+CLIENT_POOL_SIZE = 64  # clients kept in memory with an open log file
+CLIENT_IDLE_TIMEOUT = 600  # seconds after which an unused client gets closed
+CONFIG_WARMUP = True  # load all device configs at startup, parse errors are logged immediately
+CONFIG_WORKERS = None  # processes parsing configs at startup and big .hjson files, None for the number of CPUs, 0 to parse inline
+CONFIG_INLINE_SIZE = 8192  # .hjson files up to this size in bytes are parsed without a worker process
+CONFIG_COMPILED_CACHE = True  # keep parsed .hjson files as json in a .cache directory next to them
+CONFIG_WATCH = True  # push changed configs to devices that sent {"push": true} in their login options, files are only watched after such a login
+CONFIG_WATCH_DEBOUNCE = 1  # seconds without further changes before a changed config is pushed
+CONFIG_WATCH_INTERVAL = 2  # seconds between checks for changes if inotify_simple is not installed
+SHARDS = 0  # worker processes handling the devices, 0 to handle everything in one process (see README)
+DEVICE_STATE_FILE = "Logs/devices.json"  # snapshot of the presence and login history of all devices, None to keep it in memory only
+DEVICE_SNAPSHOT_INTERVAL = 60  # seconds between writing DEVICE_STATE_FILE and publishing the device summary
+DEVICE_ONLINE_TIMEOUT = 600  # seconds after the last login or log message until a device counts as offline
+REBOOT_LOOP_COUNT = 5  # a device logging in this many times within REBOOT_LOOP_WINDOW seconds is in a reboot loop
+REBOOT_LOOP_WINDOW = 600
+IO_THREADS = 4  # threads used for disk access (client directories, config files)
+
+
+"""
+Metrics
+"""
+METRICS_PORT = None  # port of the http endpoint serving metrics on /metrics, None to disable
+METRICS_HOST = "127.0.0.1"
+STATS_INTERVAL = 60  # seconds between publishing the metrics to <MQTT_HOME>/SmartServer/stats, 0 to disable
@@ -10,7 +10,9 @@ __version__ = "1.3.1"
 __updated__ = "2018-04-24"
 
 import os
+import time
 import json
+import signal
 
 os.chdir(os.path.dirname(os.path.realpath(__file__)))
 if "config.py" not in os.listdir():
@@ -23,15 +25,82 @@ from utils.mqtt import MQTTHandler
 import asyncio
 import logging
 from utils import clients
+from utils import executor
+from utils import configs
+from utils import metrics
+from utils import logstore
+from utils import watcher
+from utils import shards
+from utils import devices as device_states
+from utils import dedup as log_dedup
+import atexit
 
 log = logging.getLogger("Main")
 
-loop = asyncio.get_event_loop()
-mqtt = MQTTHandler()
+# created when started as script or in a shard worker process, so the module can be
+# imported by the spawned shard workers without connecting
+loop = None
+mqtt = None
+front = None  # shards.Front in the sharded mode
+store = None
+dedup = None  # log_dedup.Deduplicator if repeated log messages are collapsed
+devices = None  # device_states.Devices, presence and sessions of the devices handled by this process
+_push = {}  # device id: delivery settings and last sent hashes of devices that want config changes pushed
+_watcher = None  # watcher.Watcher, started by the first device that wants config changes pushed
+_deliveries = {}  # device id: task of the component delivery currently running
+
+
+def openStore():
+    global store
+    if getattr(config, "LOG_DB", None):
+        store = logstore.LogStore(config.LOG_DB, getattr(config, "LOG_DB_RETENTION", 30))
+        store.start()
+        atexit.register(store.stop)
+        metrics.register("logstore_queue_length", store.qsize)
+
+
+def openDevices(path, select=None):
+    """ Loads the device states saved by this process or, after changing SHARDS, by the others """
+    global devices
+    devices = device_states.Devices(path)
+    if path is None:
+        return
+    root = os.path.splitext(path)[0].split(".shard")[0]
+    for pattern in (root + ".json", root + ".shard*.json"):
+        devices.load(pattern, select)
+    atexit.register(_saveDevices)
+
+
+def _saveDevices():
+    snapshot = devices.snapshot()
+    if snapshot is not None:
+        devices.save(snapshot)
+
+
+async def _snapshotDevices(interval):
+    """ Writes the device states and publishes a summary periodically instead of on every message """
+    while True:
+        await asyncio.sleep(interval)
+        if devices.path is not None:
+            snapshot = devices.snapshot()
+            if snapshot is not None:
+                await executor.run(devices.save, snapshot)
+        if mqtt.is_connected():
+            mqtt.publish(mqtt.getDeviceTopic("devices"), devices.summary(), retain=True)
+
+
+def _deviceStatePath(index=None):
+    path = getattr(config, "DEVICE_STATE_FILE", os.path.join(config.LOG_FOLDER, "devices.json"))
+    if path is None or index is None:
+        return path
+    return "{!s}.shard{!s}.json".format(os.path.splitext(path)[0], index)
 
 
 async def sendConfig(topic, msg, retain):
-    log.debug("sendConfig main: {!s},{!s}".format(topic, msg))
+    log.debug("sendConfig main: %s,%s", topic, msg)
+    platform = None
+    wait = None
+    options = {}
     if topic == "{!s}/login".format(config.MQTT_HOME):
         # compatibility mode, gets dict: {"command": "login", "id": self.id, "version": config.VERSION})
         # version <3.4.0
@@ -47,25 +116,160 @@ async def sendConfig(topic, msg, retain):
                        len("{!s}/login/".format(config.MQTT_HOME)):topic.rfind("/set")]
         version = msg
         if type(version) == list:
-            version, platform, wait = version
-        else:
-            platform = None
-            wait = None
+            # [version, platform, wait] optionally followed by a dict of delivery options
+            version, platform, wait, *extra = version
+            if len(extra) > 0 and type(extra[0]) == dict:
+                options = extra[0]
     log.info(
         "Config request from {!s} version {!s} platform {!s}".format(device, version, platform))
-    client = await clients.getClient(device, version)
-    conf = client.getConfig()
-    log.debug("Config for {!s}: {!s}".format(device, conf))
-    if platform is None:
-        mqtt.publish("{!s}/login/{!s}".format(config.MQTT_HOME, device),
-                     conf, retain=False, qos=1)
+    devices.login(device, version, platform)
+    # retained, so the last login of every device can be looked up at the broker
+    mqtt.publish("{!s}/SmartServer/devices/{!s}".format(config.MQTT_HOME, device),
+                 devices.get(device).toDict(), retain=True)
+    async with clients.client(device, version) as client:
+        entry = await executor.run(client.getConfigEntry)
+        name = client.device_name
+    # client is not kept locked while the config is sent so logs of the device don't have to wait
+    log.debug("Config for %s: %s", device, entry.config)
+    known = options.get("hash", False)  # device supports hashes if it sends the key, even as null
+    if options.get("push"):
+        _push[device] = {"platform": platform, "wait": wait, "options": options, "hash": entry.hash,
+                         "hashes": entry.hashes, "name": name, "signature": entry.signature}
+        _watchPushDevices()
+    elif _push.pop(device, None) is not None:
+        _watchPushDevices()
+    _deliver(device, entry, platform, wait, options, known)
+
+
+def _deliver(device, entry, platform, wait, options, known, push=False):
+    """
+    Publishes the config as a whole or by components, known is the hash (dict) the device has.
+    A new request of the device cancels a running delivery, pushed changes are sent after it.
+    """
+    topic = "{!s}/login/{!s}".format(config.MQTT_HOME, device)
+    previous = _deliveries.pop(device, None)
+    if previous is not None and (not push or platform is None):
+        previous.cancel()
+        previous = None
+    if known is not False and known == entry.hash:
+        log.debug("Config of %s unchanged", device)
+        mqtt.publish(topic, {"_hash": entry.hash}, qos=1)
+    elif platform is None:
+        # payload is serialized once per config change, not on every request
+        payload = entry.payload if known is False else entry.hashed_payload
+        mqtt.publish(topic, _encode(entry, payload, options), retain=False, qos=1)
+    else:
+        # paced delivery runs on its own so it doesn't block a message worker
+        task = asyncio.ensure_future(_sendComponents(device, entry, wait, options, known, previous))
+        _deliveries[device] = task
+        task.add_done_callback(lambda t: _deliveries.pop(device) if _deliveries.get(device) is t else None)
+
+
+def _encode(entry, payload, options):
+    """ Compresses a config payload if the device asked for an encoding """
+    encoding = options.get("encoding")
+    if encoding is None:
+        return payload
+    if encoding not in configs.ENCODINGS:
+        log.error("Unsupported config encoding {!r}, sending json".format(encoding))
+        return payload
+    wbits = options.get("wbits", 10)
+    if type(wbits) != int or wbits not in configs.WBITS:
+        log.error("Unsupported wbits {!r} for config encoding, sending json".format(wbits))
+        return payload
+    return entry.encode(payload, encoding, wbits)
+
+
+async def _sendComponents(device, entry, wait, options, known=False, previous=None):
+    """ Runs as its own task, so errors are logged here. Waits for the previous delivery to the device """
+    try:
+        if previous is not None:
+            # cancelling this task also cancels the awaited one
+            await previous
+        await _publishComponents(device, entry, wait, options, known)
+    except Exception as e:
+        log.error("Config delivery to {!s} failed: {!s}".format(device, e))
+
+
+async def _publishComponents(device, entry, wait, options, known=False):
+    """
+    Publishes the number of components and then every component on its own topic.
+    Each message waits for the broker to acknowledge it before the next one is sent,
+    wait is the minimum interval between messages the device asked for.
+    Components bigger than options["max_payload"] are split into parts published to
+    <component>/<part>/<number of parts>.
+    If the device sent the hashes of its components, only changed components are sent
+    and the component count is replaced by a dict of the order, hashes and sent components.
+    """
+    topic = "{!s}/login/{!s}".format(config.MQTT_HOME, device)
+    max_payload = options.get("max_payload")
+    order = entry.config.get("_order")
+    if order is None:
+        # config.(h)json without _order
+        log.error("Config of {!s} has no _order, sending its components in file order".format(device))
+        order = list(entry.components)
+    missing = [c for c in order if c not in entry.components]
+    if missing:
+        log.error("Config of {!s}: components in _order without config not sent: {!s}".format(device, missing))
+        order = [c for c in order if c in entry.components]
+    if known is False:
+        components = order
+        await mqtt.publishAsync(topic, len(order))
     else:
-        i = len(conf["_order"])
-        mqtt.publish("{!s}/login/{!s}".format(config.MQTT_HOME, device), i, qos=1)
-        for component in conf["_order"]:
-            await asyncio.sleep(wait)
-            mqtt.publish("{!s}/login/{!s}/{!s}".format(config.MQTT_HOME, device, component),
-                         json.dumps(conf[component]), qos=1)
+        if type(known) != dict:
+            known = {}
+        components = [c for c in order if known.get(c) != entry.hashes[c]]
+        await mqtt.publishAsync(topic, {"_hash": entry.hash, "_order": order, "_hashes": entry.hashes,
+                                        "_changed": components})
+        log.debug("Sending %s/%s changed components to %s", len(components), len(order), device)
+    last = time.monotonic()
+    for component in components:
+        payload = _encode(entry, entry.components[component], options)
+        if max_payload and len(payload) > max_payload:
+            parts = [payload[i:i + max_payload] for i in range(0, len(payload), max_payload)]
+            messages = [("{!s}/{!s}/{!s}/{!s}".format(topic, component, i, len(parts)), part)
+                        for i, part in enumerate(parts)]
+        else:
+            messages = [("{!s}/{!s}".format(topic, component), payload)]
+        for ctopic, payload in messages:
+            if wait:
+                await asyncio.sleep(wait - (time.monotonic() - last))
+            last = time.monotonic()
+            if not await mqtt.publishAsync(ctopic, payload):
+                log.error("Config delivery to {!s} aborted, component {!s} not acknowledged".format(
+                    device, component))
+                return
+
+
+async def pushChanges(changed):
+    """
+    Sends the changed components to all devices that asked for config changes to be pushed.
+    changed is a set of directory names in Clients, a template change affects all devices.
+    Runs as its own task started by the watcher, so errors are logged here.
+    """
+    for device, state in list(_push.items()):
+        if configs.TEMPLATES_DIR not in changed and clients.getDeviceName(device) not in changed:
+            continue
+        try:
+            await _pushDevice(device, state)
+        except Exception as e:
+            log.error("Pushing the changed config to {!s} ({!s}) failed: {!s}".format(device, state["name"], e))
+
+
+async def _pushDevice(device, state):
+    async with clients.client(device) as client:
+        entry = await executor.run(client.getConfigEntry)
+    if entry.hash == state["hash"]:
+        return
+    log.info("Pushing changed config to {!s}".format(device))
+    # whole config can only be sent completely, components are compared to the last sent hashes
+    _deliver(device, entry, state["platform"], state["wait"], state["options"],
+             state["hash"] if state["platform"] is None else state["hashes"], push=True)
+    state["hash"] = entry.hash
+    state["hashes"] = entry.hashes
+
+
+LOG_LEVELS = ("critical", "error", "warn", "info", "debug")
 
 
 async def getLog(topic, msg, retain):
@@ -75,27 +279,203 @@ async def getLog(topic, msg, retain):
         return
     level = topic[2]
     device = topic[3]
-    client = await clients.getClient(device)
-    if level not in ["critical", "error", "warn", "info", "debug"]:
-        log.error("Client {!s}, Loglevel not supported: {!s}".format(device, level))
-        client.log.error("[SmartServer] Loglevel not supported: {!s}".format(level))
-        return False
-    clg = getattr(client.log, level)
-    clg(msg)
+    devices.seen(device, level)
+    if dedup is not None and level in LOG_LEVELS:
+        # repeated messages are dropped before the client gets locked or anything is written
+        records = dedup.filter(device, level, msg)
+        if not records:
+            return
+    else:
+        records = ((level, msg),)
+    return await _writeLog(device, records)
+
+
+async def _writeLog(device, records):
+    async with clients.client(device) as client:
+        for level, msg in records:
+            if level not in LOG_LEVELS:
+                log.error("Client {!s}, Loglevel not supported: {!s}".format(device, level))
+                client.log.error("[SmartServer] Loglevel not supported: {!s}".format(level))
+                return False
+            clg = getattr(client.log, level)
+            clg(msg)
+            if store is not None:
+                store.add(client.device_name, level, msg)
+
+
+def openDedup():
+    global dedup
+    window = getattr(config, "LOG_DEDUP_WINDOW", 60)
+    if window:
+        dedup = log_dedup.Deduplicator(window, getattr(config, "LOG_DEDUP_SIZE", 8))
+        metrics.register("log_deduplicated_total", lambda: dedup.suppressed, "counter")
+        asyncio.ensure_future(_flushRepeats())
+
+
+async def _flushRepeats():
+    """ Writes the summaries of repeated messages after their window ended """
+    while True:
+        await asyncio.sleep(1)
+        for device, level, summary in dedup.expired():
+            try:
+                await _writeLog(device, ((level, summary),))
+            except Exception as e:
+                log.error("Error writing repeated messages of {!s}: {!s}".format(device, e))
+
+
+def _logRateLimit():
+    rate_limit = getattr(config, "LOG_RATE_LIMIT", None)
+    return (rate_limit, getattr(config, "LOG_RATE_BURST", None)) if rate_limit else None
+
+
+def _watchPushDevices():
+    """ Config files are only watched while devices want their config changes pushed """
+    global _watcher
+    if not getattr(config, "CONFIG_WATCH", True):
+        return
+    if _watcher is None:
+        if not _push:
+            return
+        _watcher = watcher.Watcher(
+            lambda changed: loop.call_soon_threadsafe(asyncio.ensure_future, pushChanges(changed)),
+            debounce=getattr(config, "CONFIG_WATCH_DEBOUNCE", 1),
+            interval=getattr(config, "CONFIG_WATCH_INTERVAL", 2))
+        _watcher.start()
+    _watcher.setDevices({state["name"]: state["signature"] for state in _push.values()})
+
+
+async def _warmup(select=None):
+    """ Configs are also loaded on request, so the server starts even if the warmup failed """
+    try:
+        await executor.run(configs.warmup, select)
+    except Exception as e:
+        log.error("Loading the configs at startup failed: {!s}".format(e))
 
 
 async def main():
-    await mqtt.subscribe("{!s}/login/#".format(config.MQTT_HOME), sendConfig, check_retained=False)
-    await mqtt.subscribe("{!s}/log/#".format(config.MQTT_HOME), getLog, check_retained=False)
+    openDedup()
+    asyncio.ensure_future(_snapshotDevices(getattr(config, "DEVICE_SNAPSHOT_INTERVAL", 60)))
+    await _subscribe(_logRateLimit())
+    if getattr(config, "CONFIG_WARMUP", True):
+        # subscribed first so no request gets lost, configs not loaded yet are loaded on request
+        asyncio.ensure_future(_warmup())
+    if getattr(config, "METRICS_PORT", None):
+        await metrics.serve(config.METRICS_PORT, getattr(config, "METRICS_HOST", "127.0.0.1"))
     log.info("Starting main loop")
     while True:
         await asyncio.sleep(1)
 
 
-try:
-    loop.run_until_complete(main())
-except KeyboardInterrupt:
-    loop.close()
-except Exception as e:
-    log.info("Got Exception: {!s}".format(e))
-log.info("Stopping SmartServer")
+def _deviceOf(topic):
+    """ Device id of a log or config request topic, None for other topics """
+    if topic.startswith("{!s}/log/".format(config.MQTT_HOME)):
+        levels = topic.split("/")
+        return levels[3] if len(levels) > 3 else ""  # same as in getLog
+    if topic.endswith("/set") and topic.startswith("{!s}/login/".format(config.MQTT_HOME)):
+        return topic[len("{!s}/login/".format(config.MQTT_HOME)):-4]
+    return None
+
+
+async def _subscribe(log_rate_limit=None):
+    # messages of a device are processed in order by one worker at a time,
+    # so a flooding device can't occupy the workers of all other devices
+    await mqtt.subscribe("{!s}/login/#".format(config.MQTT_HOME), sendConfig, check_retained=False,
+                         order_by=_deviceOf)
+    # log messages are plain text, they don't need to go through the json parser
+    await mqtt.subscribe("{!s}/log/#".format(config.MQTT_HOME), getLog, check_retained=False,
+                         rate_limit=log_rate_limit, decode="text", order_by=_deviceOf)
+
+
+def _route(topic, payload, retain):
+    """ Front process of the sharded mode: forwards login and log messages to the shard of their device """
+    device = _deviceOf(topic)
+    if device is None:
+        if topic != "{!s}/login".format(config.MQTT_HOME):
+            return  # own answer to a login topic
+        try:
+            device = json.loads(payload)["id"]
+        except Exception:
+            device = ""
+    front.send(device, ("msg", topic, payload, retain))
+
+
+async def frontMain(count):
+    global front
+    front = shards.Front(count, _shard, getattr(config, "MQTT_QUEUE_SIZE", 1000))
+    mqtt.route("{!s}/login/#".format(config.MQTT_HOME), _route)
+    mqtt.route("{!s}/log/#".format(config.MQTT_HOME), _route, rate_limit=_logRateLimit())
+    if getattr(config, "METRICS_PORT", None):
+        await metrics.serve(config.METRICS_PORT, getattr(config, "METRICS_HOST", "127.0.0.1"))
+    log.info("Starting main loop with {!s} shards".format(count))
+    while True:
+        await asyncio.sleep(1)
+        front.check()
+
+
+def _fromFront(item):
+    mqtt.dispatch(*item[1:])
+
+
+async def _shardMain(index, count, items):
+    openDedup()
+    asyncio.ensure_future(_snapshotDevices(getattr(config, "DEVICE_SNAPSHOT_INTERVAL", 60)))
+    await _subscribe()
+    shards.receive(items, _fromFront)
+    if getattr(config, "CONFIG_WARMUP", True):
+        asyncio.ensure_future(_warmup(
+            lambda name: any(shards.shardOf(device, count) == index for device in clients.getDeviceIds(name))))
+    while shards.frontAlive():
+        await asyncio.sleep(1)
+    log.error("Front process exited, stopping shard {!s}".format(index))
+
+
+def _terminate():
+    # SIGTERM (e.g. docker stop) ends the process like Ctrl+C, so buffered logs and states get written
+    raise SystemExit(0)
+
+
+def _flushShard():
+    """ atexit hooks don't run in multiprocessing children, so a shard writes everything on its own """
+    if devices.path is not None:
+        _saveDevices()
+    if store is not None:
+        store.stop()
+    clients.flushDeviceNames()
+    logging_config.writer.stop()
+
+
+def _shard(index, count, items, log_queue):
+    """ Entry of a shard worker process, handles the devices the front process forwards to it """
+    global loop, mqtt
+    logging_config.forwardTo(log_queue)
+    configs.WORKERS = 0  # shards already parse configs in parallel
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    mqtt = MQTTHandler(listen=False, id="SmartServer/shard{!s}".format(index))
+    openStore()
+    openDevices(_deviceStatePath(index), lambda device: shards.shardOf(device, count) == index)
+    loop.add_signal_handler(signal.SIGTERM, _terminate)
+    try:
+        loop.run_until_complete(_shardMain(index, count, items))
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        _flushShard()
+
+
+if __name__ == "__main__":
+    loop = asyncio.get_event_loop()
+    mqtt = MQTTHandler()
+    loop.add_signal_handler(signal.SIGTERM, _terminate)
+    try:
+        if getattr(config, "SHARDS", 0):
+            loop.run_until_complete(frontMain(config.SHARDS))
+        else:
+            openStore()
+            openDevices(_deviceStatePath())
+            loop.run_until_complete(main())
+    except (KeyboardInterrupt, SystemExit):
+        loop.close()
+    except Exception as e:
+        log.info("Got Exception: {!s}".format(e))
+    log.info("Stopping SmartServer")
@@ -4,62 +4,243 @@ Created on 10.04.2018
 @author: Kevin
 '''
 
-import json
 import yaml
 import logging
-import logging.handlers
 log = logging.getLogger("Clients")
 import asyncio
 import os
 import shutil
-try:
-    import hjson
-    HJSON_AVAILABLE = True
-except Exception:
-    log.debug("Library hjson not available, .hjson files won't be recognized")
-    HJSON_AVAILABLE = False
+import threading
+import time
+import atexit
+import collections
+import contextlib
+import config
+from utils import configs
+from utils import executor
+from utils import logging_config
+from utils import metrics
 
-locks = {}
+POOL_SIZE = getattr(config, "CLIENT_POOL_SIZE", 64)
+IDLE_TIMEOUT = getattr(config, "CLIENT_IDLE_TIMEOUT", 600)
 
+_locks = {}  # device id: _DeviceLock, only for devices currently in use
+_clients = collections.OrderedDict()  # device id: Client, least recently used first
+_pool_lock = threading.Lock()
+_handlers = {}  # device name: [handler, number of clients using it]
+_handlers_lock = threading.Lock()
+metrics.register("clients_open", lambda: len(_clients))
 
-async def getClient(device, version=None):
-    if device not in locks:
-        locks[device] = asyncio.Lock()
-    await locks[device].acquire()
-    return Client(device, version)
 
+class _DeviceLock:
+    __slots__ = ("lock", "users")
 
-def getDeviceName(device):
-    #print("getDeviceName: {!s}".format(device))
-    if os.path.exists("device_names.yaml") == False:
-        f = open("device_names.yaml", "w")
-        f.close()
-    with open("device_names.yaml", "r") as f:
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.users = 0
+
+
+@contextlib.asynccontextmanager
+async def client(device, version=None):
+    """
+    async with clients.client(device) as client:
+    Gives exclusive access to the pooled client object of a device.
+    Waiters of a device are served in the order they arrived (asyncio.Lock is FIFO),
+    so messages of one device are processed in order while other devices run concurrently.
+    """
+    dlock = _locks.get(device)
+    if dlock is None:
+        dlock = _locks[device] = _DeviceLock()
+    dlock.users += 1
+    try:
+        start = time.perf_counter()
+        async with dlock.lock:
+            metrics.observe("client_lock_wait_seconds", time.perf_counter() - start)
+            yield await executor.run(_getClient, device, version)
+    finally:
+        dlock.users -= 1
+        if dlock.users == 0:
+            del _locks[device]
+
+
+def _getClient(device, version=None):
+    """ Runs in the I/O executor while the device lock is held """
+    with _pool_lock:
+        client = _clients.pop(device, None)
+    if client is not None and client.device_name != getDeviceName(device):
+        # device got renamed in device_names.yaml
+        client.close()
+        client = None
+    if client is None:
+        client = Client(device, version)
+    elif version is not None:
+        client.version = version
+    client.last_used = time.monotonic()
+    with _pool_lock:
+        _clients[device] = client
+        evicted = _evictClients()
+    for old in evicted:
+        old.close()
+    return client
+
+
+def _evictClients():
+    """ Removes least recently used clients if the pool is full or they have been idle for too long """
+    evicted = []
+    now = time.monotonic()
+    for device in list(_clients):
+        client = _clients[device]
+        if len(_clients) <= POOL_SIZE and now - client.last_used < IDLE_TIMEOUT:
+            break
+        if device in _locks:
+            continue  # client in use
+        del _clients[device]
+        evicted.append(client)
+    return evicted
+
+
+class _DeviceNames:
+    """ Resident copy of device_names.yaml, only reloaded if the file changed on disk.
+    Unknown device ids are collected and appended to the file after a short delay. """
+
+    def __init__(self, file, check_interval=1, flush_delay=2):
+        self._file = file
+        self._check_interval = check_interval
+        self._flush_delay = flush_delay
+        self._names = {}
+        self._stat = None
+        self._checked = None
+        self._pending = []
+        self._timer = None
+        self._lock = threading.Lock()
+        atexit.register(self.flush)
+
+    def _getStat(self):
         try:
-            names = yaml.load(f)
-            if names is None:
-                names = {}
-        except Exception as e:
-            log.error("Could not load device_names.yaml: {!s}".format(e))
+            st = os.stat(self._file)
+        except OSError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    def _reload(self):
+        now = time.monotonic()
+        if self._checked is not None and now - self._checked < self._check_interval:
+            return
+        self._checked = now
+        stat = self._getStat()
+        if stat == self._stat:
+            return
+        names = {}
+        if stat is not None:
+            try:
+                with open(self._file, "r") as f:
+                    names = yaml.safe_load(f) or {}
+            except Exception as e:
+                log.error("Could not load {!s}: {!s}".format(self._file, e))
+                return
+        for device in self._pending:
+            names.setdefault(device, None)
+        self._names = names
+        self._stat = stat
+        log.debug("Loaded {!s} device names".format(len(names)))
+
+    def get(self, device):
+        with self._lock:
+            self._reload()
+            if device in self._names:
+                return self._names[device] or device
+            self._names[device] = None
+            self._pending.append(device)
+            if self._timer is None:
+                self._timer = threading.Timer(self._flush_delay, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
             return device
-        if device in names:
-            if names[device] is not None:
-                return names[device]
-            else:
-                return device
-        else:
-            names[device] = None
-    with open("device_names.yaml", "w") as f:
-        yaml.dump(names, f, default_flow_style=False)
-        return device
+
+    def ids(self, name):
+        """ Returns the device ids using a device name """
+        with self._lock:
+            self._reload()
+            return [device for device, n in self._names.items() if (n or device) == name] or [name]
+
+    def flush(self):
+        """ Appends all new device ids to the file instead of rewriting it """
+        with self._lock:
+            self._timer = None
+            if len(self._pending) == 0:
+                return
+            try:
+                newline = False
+                if self._getStat() is not None:
+                    with open(self._file, "rb") as f:
+                        f.seek(0, os.SEEK_END)
+                        if f.tell() > 0:
+                            f.seek(-1, os.SEEK_END)
+                            newline = f.read(1) != b"\n"
+                with open(self._file, "a") as f:
+                    if newline:
+                        f.write("\n")
+                    yaml.dump(dict.fromkeys(self._pending), f, default_flow_style=False)
+            except Exception as e:
+                log.error("Could not add devices to {!s}: {!s}".format(self._file, e))
+                return
+            log.debug("Added {!s} new devices to {!s}".format(len(self._pending), self._file))
+            self._pending = []
+            self._checked = None  # file changed, also picks up edits made in the meantime
+
+
+_device_names = _DeviceNames("device_names.yaml")
+
+
+def getDeviceName(device):
+    return _device_names.get(device)
+
+
+def getDeviceIds(device_name):
+    return _device_names.ids(device_name)
+
+
+def flushDeviceNames():
+    _device_names.flush()
+
+
+def _openHandler(device_name):
+    """ Returns the log file handler of a device name, shared by all clients using that name """
+    with _handlers_lock:
+        entry = _handlers.get(device_name)
+        if entry is None:
+            handler = logging_config.BufferedRotatingFileHandler("{!s}/Clients/{!s}/{!s}.log".format(
+                os.getcwd(), device_name, device_name))
+            formatter = logging.Formatter('[%(asctime)s] [%(levelname)s] %(message)s')
+            handler.setFormatter(formatter)
+            # file is only written by the log writer thread
+            entry = _handlers[device_name] = [logging_config.QueuedHandler(handler), 0]
+            logging.getLogger(device_name).addHandler(entry[0])
+        entry[1] += 1
+        return entry[0]
+
+
+def _closeHandler(device_name, handler):
+    """ Closes the log file handler of a device name when its last client is closed """
+    with _handlers_lock:
+        entry = _handlers.get(device_name)
+        if entry is None or entry[0] is not handler:
+            return
+        entry[1] -= 1
+        if entry[1] > 0:
+            return
+        del _handlers[device_name]
+        logging.getLogger(device_name).removeHandler(handler)
+    handler.close()
 
 
 class Client:
-    """ Temporary wrapper representing a client object with logger """
+    """ Wrapper representing a client object with logger, kept in a pool between messages """
 
     def __init__(self, device, version=None):
         self.id = device
         self.version = version
+        self.last_used = time.monotonic()
         oslist = os.listdir(os.getcwd())
         if "Clients" not in oslist:
             os.mkdir("Clients")
@@ -79,65 +260,16 @@ class Client:
         oslist = os.listdir(os.getcwd() + "/Clients/" + self.device_name)
         if "config" not in oslist:
             os.mkdir(os.getcwd() + "/Clients/" + self.device_name + "/config")
-        handler = logging.handlers.RotatingFileHandler("{!s}/Clients/{!s}/{!s}.log".format(
-            os.getcwd(), self.device_name, self.device_name), maxBytes=1024 * 1024, backupCount=5)
-        formatter = logging.Formatter('[%(asctime)s] [%(levelname)s] %(message)s')
-        handler.setFormatter(formatter)
-        self.log.addHandler(handler)
+        # device ids sharing a name also share the logger and its file
+        self._handler = _openHandler(self.device_name)
         #log.debug("Created Client object {!s}".format(self.device_name))
 
-    def __del__(self):
+    def close(self):
         #log.debug("Closing Client object {!s}".format(self.device_name))
-        locks[self.id].release()
-        handlers = self.log.handlers[:]
-        for handler in handlers:
-            handler.close()
-            self.log.removeHandler(handler)
-
-    def getConfig(self):
-        """ At the moment config directory has to have an _order.json file to get dependencies right"""
-        log.debug("Get config")
-        oslist = os.listdir(os.getcwd() + "/Clients/" + self.device_name)
-        if "config.json" in oslist or "config.hjson" in oslist:
-            file = "config.hjson" if "config.hjson" in oslist else "config.json"
-            if file == "config.hjson" and HJSON_AVAILABLE == False:
-                log.critical("Found config.hjson but hjson library unavailable")
-                return {"_order": []}
-            with open(os.getcwd() + "/Clients/" + self.device_name + "/" + file, "r") as f:
-                try:
-                    if file.rfind(".hjson") != -1:
-                        return dict(hjson.load(f))
-                    elif file.rfind(".json") != -1:
-                        return json.load(f)
-                except Exception as e:
-                    log.error("Error loading {!s}: {!s}".format(file, e))
-                    return {"_order": []}
-        conf = {}
-        oslist = os.listdir(os.getcwd() + "/Clients/" + self.device_name + "/config/")
-        for file in oslist:
-            component = file.rstrip(".json").rstrip(".hjson")
-            if file.rfind(".hjson") == -1 or HJSON_AVAILABLE == True:
-                with open(os.getcwd() + "/Clients/" + self.device_name + "/config/" + file, "r") as f:
-                    try:
-                        if file.rfind(".hjson") != -1:
-                            com_conf = hjson.load(f)
-                            conf[component] = com_conf
-                        elif file.rfind(".json") != -1:
-                            com_conf = json.load(f)
-                            conf[component] = com_conf
-                        else:
-                            log.error("Unsupported config file format: {!s}".format(f))
-                    except:
-                        self.log.error(
-                            "[SmartServer] Could not load config component {!s}:{!s}".format(component, e))
-                        log.error("Could not load config component {!s}:{!s}".format(component, e))
-            else:
-                log.warn("config file {!s} could not be loaded as hjson library is missing".format(file))
-        if "_order" not in conf:
-            # easy configs might not need any dependencies
-            order = []
-            for component in conf:
-                order.append(component)
-            conf["_order"] = order
-        return conf
-        # TODO: add possibility to make config with dependencies and automatic resolve
+        if self._handler is not None:
+            _closeHandler(self.device_name, self._handler)
+            self._handler = None
+
+    def getConfigEntry(self):
+        """ Returns the cache entry containing the config and its json payload, blocking """
+        return configs.get(self.device_name, self.log)
@@ -0,0 +1,447 @@
+# Cache of assembled device configurations.
+# A config is only reloaded from disk if one of its files changed (mtime or size)
+# so repeated config requests don't re-parse every .json/.hjson file.
+# Parsed .hjson files are additionally stored as json in a .cache directory next to them,
+# so hjson (pure python) is only parsed once per edit, even across restarts.
+# Big .hjson files are parsed in a process pool to not hold the GIL of the event loop.
+#
+# Devices can use shared component files from Clients/_templates/<group>/ by listing the
+# groups in config/_templates.(h)json. Components are deep merged in the order of the groups,
+# the device's own files override the templates. Components can declare "_depends": [...],
+# the _order is then resolved by a topological sort if no explicit _order is given.
+
+import atexit
+import hashlib
+import json
+import logging
+import os
+import time
+import zlib
+import concurrent.futures
+import multiprocessing
+import threading
+import config
+from utils import metrics
+
+log = logging.getLogger("Configs")
+try:
+    import hjson
+    HJSON_AVAILABLE = True
+except Exception:
+    log.debug("Library hjson not available, .hjson files won't be recognized")
+    HJSON_AVAILABLE = False
+
+CLIENTS_DIR = "Clients"
+TEMPLATES_DIR = "_templates"
+WORKERS = getattr(config, "CONFIG_WORKERS", None)
+INLINE_SIZE = getattr(config, "CONFIG_INLINE_SIZE", 8192)  # smaller .hjson files are parsed without the pool
+COMPILED_CACHE = getattr(config, "CONFIG_COMPILED_CACHE", True)
+
+_cache = {}
+_groups = {}  # path of _templates file: ((mtime_ns, size), groups)
+_templates = {}  # group: (signature, components)
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _getPool():
+    """ Returns the process pool or None if WORKERS is 0 """
+    global _pool
+    if WORKERS == 0:
+        return None
+    with _pool_lock:
+        if _pool is None:
+            # created from an I/O thread while the log threads are running, forking
+            # could copy a lock held by another thread into the workers
+            _pool = concurrent.futures.ProcessPoolExecutor(WORKERS, mp_context=multiprocessing.get_context("spawn"))
+            atexit.register(_pool.shutdown)
+        return _pool
+
+
+def _hash(payload):
+    return hashlib.sha1(payload.encode()).hexdigest()[:8]
+
+
+def _zlib(data, wbits):
+    # small windows so the decompression works with little RAM, e.g. using uzlib on esp8266
+    compressor = zlib.compressobj(9, zlib.DEFLATED, wbits)
+    return compressor.compress(data) + compressor.flush()
+
+
+ENCODINGS = {
+    "zlib": lambda data, wbits: _zlib(data, wbits),
+    "deflate": lambda data, wbits: _zlib(data, -wbits),  # raw stream without zlib header
+}
+WBITS = range(9, 16)  # window sizes zlib can compress with
+
+
+class Entry:
+    __slots__ = ("signature", "config", "payload", "hash", "components", "hashes", "encoded", "_hashed")
+
+    def __init__(self, signature, config):
+        self.signature = signature
+        self.config = config
+        self.payload = json.dumps(config)
+        self.hash = _hash(self.payload)
+        # components serialized for the single component delivery
+        self.components = {component: json.dumps(value) for component, value in config.items()
+                           if component != "_order"}
+        self.hashes = {component: _hash(payload) for component, payload in self.components.items()}
+        self.encoded = {}
+        self._hashed = None
+
+    @property
+    def hashed_payload(self):
+        """ Payload of the config with the additional key _hash, serialized on first use """
+        if self._hashed is None:
+            self._hashed = json.dumps(dict(self.config, _hash=self.hash))
+        return self._hashed
+
+    def encode(self, payload, encoding, wbits=10):
+        """ Returns a payload of this config compressed with encoding, cached until the config changes """
+        key = (encoding, wbits, payload)
+        data = self.encoded.get(key)
+        if data is None:
+            data = ENCODINGS[encoding](payload.encode(), wbits)
+            self.encoded[key] = data
+            log.info("Compressed payload with {!s}: {!s} -> {!s} bytes ({:.0%})".format(
+                encoding, len(payload), len(data), len(data) / len(payload)))
+        return data
+
+
+def _stat(path, name):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return name, st.st_mtime_ns, st.st_size
+
+
+def _dirSignature(path, prefix, files):
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                if entry.is_file() and entry.name[:1] != ".":
+                    st = entry.stat()
+                    files.append((prefix + entry.name, st.st_mtime_ns, st.st_size))
+    except OSError:
+        pass
+    return files
+
+
+def fileSignature(device_name):
+    """ Returns the names, mtimes and sizes of all files a device config is assembled from, including templates """
+    path = os.path.join(CLIENTS_DIR, device_name)
+    files = []
+    for file in ("config.json", "config.hjson"):
+        st = _stat(os.path.join(path, file), file)
+        if st is not None:
+            files.append(st)
+    _dirSignature(os.path.join(path, "config"), "config/", files)
+    for group in _templateGroups(device_name):
+        _dirSignature(os.path.join(CLIENTS_DIR, TEMPLATES_DIR, group), "{!s}/{!s}/".format(TEMPLATES_DIR, group),
+                      files)
+    return tuple(sorted(files))
+
+
+def _templateGroups(device_name):
+    """ Returns the template groups listed in config/_templates.(h)json, memoized by mtime and size """
+    for file in ("_templates.hjson", "_templates.json"):
+        path = os.path.join(CLIENTS_DIR, device_name, "config", file)
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        cached = _groups.get(path)
+        if cached is not None and cached[0] == (st.st_mtime_ns, st.st_size):
+            return cached[1]
+        try:
+            groups = _loadFile(path)
+        except Exception:
+            groups = []  # error gets logged when the config is loaded
+        if type(groups) == str:
+            groups = [groups]
+        groups = [g for g in groups if type(g) == str and g[:1] != "." and "/" not in g and os.sep not in g]
+        _groups[path] = ((st.st_mtime_ns, st.st_size), groups)
+        return groups
+    return []
+
+
+def _readFile(path):
+    with open(path, "r") as f:
+        if path.endswith(".hjson"):
+            return hjson.load(f)
+        return json.load(f)
+
+
+def _compiledPath(path):
+    directory, file = os.path.split(path)
+    return os.path.join(directory, ".cache", file + ".json")
+
+
+def _readCompiled(path, st):
+    try:
+        with open(_compiledPath(path), "r") as f:
+            compiled = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if compiled.get("mtime_ns") != st.st_mtime_ns or compiled.get("size") != st.st_size:
+        return None
+    return compiled
+
+
+def _writeCompiled(path, st, data):
+    cpath = _compiledPath(path)
+    try:
+        os.makedirs(os.path.dirname(cpath), exist_ok=True)
+        with open(cpath + ".tmp", "w") as f:
+            json.dump({"mtime_ns": st.st_mtime_ns, "size": st.st_size, "data": data}, f)
+        os.replace(cpath + ".tmp", cpath)
+    except (OSError, TypeError, ValueError) as e:
+        log.debug("Could not write compiled config {!s}: {!s}".format(cpath, e))
+
+
+def _loadFile(path, pool=True):
+    """
+    Parses a config file. A .hjson file is read from its compiled cache if it didn't change,
+    otherwise it is parsed (in the process pool if it is big) and the result gets cached.
+    """
+    if not path.endswith(".hjson"):
+        return _readFile(path)
+    st = os.stat(path)
+    compiled = _readCompiled(path, st) if COMPILED_CACHE else None
+    if compiled is not None:
+        return compiled["data"]
+    data = None
+    if pool and st.st_size > INLINE_SIZE and WORKERS != 0:
+        try:
+            data, error = _getPool().submit(_parseFile, path, False).result()
+        except Exception as e:
+            log.error("Could not parse {!s} in the process pool, parsing inline: {!s}".format(path, e))
+        else:
+            if error is not None:
+                raise ValueError(error)
+    if data is None:
+        data = _readFile(path)
+    if COMPILED_CACHE:
+        _writeCompiled(path, st, data)
+    return data
+
+
+def _parseFile(path, compiled=True):
+    """ Runs in a worker process, returns (result, error) as exceptions might not be picklable """
+    try:
+        return (_loadFile(path, pool=False) if compiled else _readFile(path)), None
+    except Exception as e:
+        return None, "{!s}".format(e)
+
+
+def _loadDirectory(path, name, clog=None, loadFile=_loadFile):
+    """ Returns a dict of all component files in a directory, the filename being the key """
+    conf = {}
+    for file in sorted(os.listdir(path)):
+        if file[:1] == "." or os.path.isdir(os.path.join(path, file)):
+            continue
+        component, ext = os.path.splitext(file)
+        if ext not in (".json", ".hjson"):
+            log.error("Unsupported config file format: {!s}".format(file))
+            continue
+        if ext == ".hjson" and HJSON_AVAILABLE == False:
+            log.warn("config file {!s} could not be loaded as hjson library is missing".format(file))
+            continue
+        try:
+            conf[component] = loadFile(os.path.join(path, file))
+        except Exception as e:
+            if clog is not None:
+                clog.error("[SmartServer] Could not load config component {!s}:{!s}".format(component, e))
+            log.error("Could not load config component {!s} of {!s}: {!s}".format(component, name, e))
+    return conf
+
+
+def _loadTemplate(group, clog=None, loadFile=_loadFile):
+    """ Returns the components of a template group, memoized until one of its files changes """
+    path = os.path.join(CLIENTS_DIR, TEMPLATES_DIR, group)
+    signature = tuple(sorted(_dirSignature(path, "", [])))
+    cached = _templates.get(group)
+    if cached is not None and cached[0] == signature:
+        return cached[1]
+    if not os.path.isdir(path):
+        return None
+    conf = _loadDirectory(path, "template " + group, clog, loadFile)
+    _templates[group] = (signature, conf)
+    return conf
+
+
+def _merge(base, override):
+    """ Returns override deep merged into base, dicts are merged, everything else is replaced """
+    if not isinstance(base, dict) or not isinstance(override, dict):
+        return override
+    merged = dict(base)
+    for key, value in override.items():
+        merged[key] = _merge(base.get(key), value)
+    return merged
+
+
+def _resolveOrder(conf, name, clog=None):
+    """ Sorts the components topologically by their _depends, alphabetically where they are independent """
+    depends = {}
+    for component, value in conf.items():
+        deps = value.get("_depends", []) if isinstance(value, dict) else []
+        if type(deps) == str:
+            deps = [deps]
+        for dep in deps:
+            if dep not in conf:
+                log.warn("Config of {!s}: component {!s} depends on missing component {!s}".format(
+                    name, component, dep))
+        depends[component] = {dep for dep in deps if dep in conf and dep != component}
+    order = []
+    ready = sorted(c for c, deps in depends.items() if not deps)
+    while ready:
+        component = ready.pop(0)
+        order.append(component)
+        for other in sorted(depends):
+            deps = depends[other]
+            if component in deps:
+                deps.discard(component)
+                if not deps:
+                    ready.append(other)
+        ready.sort()
+        del depends[component]
+    if depends:
+        remaining = sorted(c for c in depends if c not in order)
+        if clog is not None:
+            clog.error("[SmartServer] Dependency cycle between components {!s}".format(remaining))
+        log.error("Config of {!s}: dependency cycle between components {!s}".format(name, remaining))
+        order.extend(remaining)
+    return order
+
+
+def load(device_name, clog=None, loadFile=_loadFile):
+    """ Assembles the config of a device from its files and templates without using the cache """
+    path = os.path.join(CLIENTS_DIR, device_name)
+    oslist = os.listdir(path)
+    if "config.json" in oslist or "config.hjson" in oslist:
+        file = "config.hjson" if "config.hjson" in oslist else "config.json"
+        if file == "config.hjson" and HJSON_AVAILABLE == False:
+            log.critical("Found config.hjson but hjson library unavailable")
+            return {"_order": []}
+        try:
+            return dict(loadFile(os.path.join(path, file)))
+        except Exception as e:
+            log.error("Error loading {!s} of {!s}: {!s}".format(file, device_name, e))
+            return {"_order": []}
+    own = _loadDirectory(os.path.join(path, "config"), device_name, clog, loadFile)
+    own.pop("_templates", None)
+    conf = {}
+    for group in _templateGroups(device_name):
+        template = _loadTemplate(group, clog, loadFile)
+        if template is None:
+            if clog is not None:
+                clog.error("[SmartServer] Template {!s} does not exist".format(group))
+            log.error("Config of {!s}: template {!s} does not exist".format(device_name, group))
+            continue
+        conf = _merge(conf, template)
+    conf = _merge(conf, own)
+    order = conf.pop("_order", None)
+    # a component set to null in the device config removes the component of a template
+    conf = {component: value for component, value in conf.items() if value is not None}
+    if order is None:
+        order = _resolveOrder(conf, device_name, clog)
+    for component, value in conf.items():
+        if isinstance(value, dict) and "_depends" in value:
+            conf[component] = {k: v for k, v in value.items() if k != "_depends"}
+    conf["_order"] = order
+    return conf
+
+
+def get(device_name, clog=None):
+    """ Returns the cache entry of a device, reloading its config if a file changed """
+    signature = fileSignature(device_name)
+    entry = _cache.get(device_name)
+    if entry is not None and entry.signature == signature:
+        metrics.inc("config_cache_total", result="hit")
+        return entry
+    metrics.inc("config_cache_total", result="miss")
+    log.debug("Loading config of %s", device_name)
+    with metrics.timer("config_load_seconds"):
+        entry = Entry(signature, load(device_name, clog))
+    _cache[device_name] = entry
+    return entry
+
+
+def _configFiles(device_name):
+    """ Returns the paths of all files load() would parse for a device """
+    path = os.path.join(CLIENTS_DIR, device_name)
+    for file in ("config.hjson", "config.json"):
+        if os.path.isfile(os.path.join(path, file)):
+            return [os.path.join(path, file)]
+    try:
+        files = os.listdir(os.path.join(path, "config"))
+    except OSError:
+        return []
+    return [os.path.join(path, "config", file) for file in files
+            if file.endswith((".json", ".hjson")) and file[:1] != "."]
+
+
+def warmup(select=None, inline_files=20):
+    """
+    Loads the configs of all devices in the Clients directory into the cache, so the first
+    config requests after a restart don't have to parse them. Files are parsed in parallel
+    in a process pool as hjson parsing is pure python. Errors are logged up front.
+    select(device_name) can limit the devices that are loaded.
+    Returns the number of configs loaded.
+    """
+    start = time.perf_counter()
+    try:
+        devices = [d for d in sorted(os.listdir(CLIENTS_DIR))
+                   if d[:1] not in ("_", ".") and os.path.isdir(os.path.join(CLIENTS_DIR, d))
+                   and (select is None or select(d))]
+    except OSError:
+        return 0
+    signatures = {device: fileSignature(device) for device in devices}
+    files = [file for device in devices for file in _configFiles(device)]
+    templates = os.path.join(CLIENTS_DIR, TEMPLATES_DIR)
+    if os.path.isdir(templates):
+        for group in sorted(os.listdir(templates)):
+            if group[:1] != "." and os.path.isdir(os.path.join(templates, group)):
+                files.extend(os.path.join(templates, group, file) for file in os.listdir(os.path.join(templates, group))
+                             if file.endswith((".json", ".hjson")) and file[:1] != ".")
+    files = [file for file in files if HJSON_AVAILABLE or not file.endswith(".hjson")]
+    results = None
+    if len(files) > inline_files and WORKERS != 0:
+        try:
+            results = dict(zip(files, _getPool().map(_parseFile, files, chunksize=16)))
+        except Exception as e:
+            log.error("Could not parse configs in a process pool, parsing inline: {!s}".format(e))
+    if results is None:
+        results = {file: _parseFile(file) for file in files}
+
+    errors = 0
+
+    def loadFile(path):
+        nonlocal errors
+        result, error = results[path] if path in results else _parseFile(path)
+        if error is not None:
+            errors += 1
+            raise ValueError(error)
+        return result
+
+    for device in devices:
+        try:
+            entry = Entry(signatures[device], load(device, loadFile=loadFile))
+            # config.(h)json is published as it is, _order is only checked for the config directory
+            if not os.path.isfile(os.path.join(CLIENTS_DIR, device, "config.json")) \
+                    and not os.path.isfile(os.path.join(CLIENTS_DIR, device, "config.hjson")):
+                missing = [c for c in entry.config.get("_order", []) if c not in entry.components]
+                if missing:
+                    errors += 1
+                    log.error("Config of {!s}: components in _order without config: {!s}".format(device, missing))
+        except Exception as e:
+            errors += 1
+            log.error("Config of {!s} could not be loaded: {!s}".format(device, e))
+            continue
+        # a request during the warmup might have loaded a newer config already
+        _cache.setdefault(device, entry)
+    log.info("Loaded {!s} configs from {!s} files in {:.2f}s, {!s} errors".format(
+        len(devices), len(files), time.perf_counter() - start, errors))
+    return len(devices)
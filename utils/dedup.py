@@ -0,0 +1,83 @@
+# Collapses repeated log messages of a device, e.g. the same error sent hundreds of times a minute.
+# The first occurrence of a message is written, further copies within the window are only counted
+# and written as a single "repeated N times" record when the window ended.
+# Every device has a small ring of its recent messages, devices without recent messages are removed.
+
+import logging
+import time
+
+log = logging.getLogger("Dedup")
+
+
+class _Repeat:
+    __slots__ = ("key", "level", "message", "first", "count")
+
+    def __init__(self, key, level, message, now):
+        self.key = key
+        self.level = level
+        self.message = message
+        self.first = now
+        self.count = 0  # copies suppressed since first
+
+
+class Deduplicator:
+    """ Only used from the event loop """
+
+    def __init__(self, window=60, size=8):
+        self.window = window
+        self.size = size  # recent messages remembered per device
+        self._devices = {}  # device: list of _Repeat, oldest first
+        self.suppressed = 0
+
+    def _summary(self, repeat, now):
+        return repeat.level, "[SmartServer] Repeated {!s} times in {:.0f}s: {!s}".format(
+            repeat.count, now - repeat.first, repeat.message)
+
+    def filter(self, device, level, message):
+        """
+        Returns the list of (level, message) records to write for a new message of a device:
+        empty if it is a repeated message, the message itself and maybe a summary of the
+        repeats of a message that is removed from the ring.
+        """
+        text = message if type(message) == str else str(message)
+        key = hash((level, text))
+        now = time.monotonic()
+        ring = self._devices.get(device)
+        if ring is None:
+            ring = self._devices[device] = []
+        records = []
+        for i, repeat in enumerate(ring):
+            if repeat.key == key and repeat.level == level and repeat.message == text:
+                if now - repeat.first < self.window:
+                    repeat.count += 1
+                    self.suppressed += 1
+                    return records
+                del ring[i]  # window ended, written again as new message
+                if repeat.count:
+                    records.append(self._summary(repeat, now))
+                break
+        if len(ring) >= self.size:
+            oldest = ring.pop(0)
+            if oldest.count:
+                records.append(self._summary(oldest, now))
+        ring.append(_Repeat(key, level, text, now))
+        records.append((level, message))
+        return records
+
+    def expired(self):
+        """ Removes messages whose window ended, returns (device, level, summary) of the ones that got repeated """
+        now = time.monotonic()
+        summaries = []
+        for device in list(self._devices):
+            ring = self._devices[device]
+            # ring is ordered by first occurrence
+            while ring and now - ring[0].first >= self.window:
+                repeat = ring.pop(0)
+                if repeat.count:
+                    summaries.append((device,) + self._summary(repeat, now))
+            if not ring:
+                del self._devices[device]
+        return summaries
+
+    def __len__(self):
+        return len(self._devices)
@@ -0,0 +1,154 @@
+# Presence and session state of all devices that sent a login or a log message.
+# The state is only kept in memory and written to a json snapshot file periodically,
+# so login and log messages don't cause any disk access.
+# A device logging in REBOOT_LOOP_COUNT times within REBOOT_LOOP_WINDOW seconds is
+# reported as being in a reboot loop.
+
+import collections
+import glob
+import json
+import logging
+import os
+import time
+import config
+from utils import metrics
+
+log = logging.getLogger("Devices")
+
+ONLINE_TIMEOUT = getattr(config, "DEVICE_ONLINE_TIMEOUT", 600)
+REBOOT_LOOP_COUNT = getattr(config, "REBOOT_LOOP_COUNT", 5)
+REBOOT_LOOP_WINDOW = getattr(config, "REBOOT_LOOP_WINDOW", 600)
+ERROR_LEVELS = ("error", "critical")
+
+
+class DeviceState:
+    __slots__ = ("id", "version", "platform", "first_seen", "last_login", "last_seen",
+                 "logins", "logs", "errors", "boots", "reboot_loop")
+
+    def __init__(self, device):
+        self.id = device
+        self.version = None
+        self.platform = None
+        self.first_seen = self.last_seen = time.time()
+        self.last_login = None
+        self.logins = 0
+        self.logs = 0
+        self.errors = 0
+        self.boots = collections.deque(maxlen=REBOOT_LOOP_COUNT)  # times of the last logins
+        self.reboot_loop = False
+
+    def online(self, now=None):
+        return (now or time.time()) - self.last_seen < ONLINE_TIMEOUT
+
+    def toDict(self):
+        return {"version": self.version, "platform": self.platform, "first_seen": self.first_seen,
+                "last_login": self.last_login, "last_seen": self.last_seen, "logins": self.logins,
+                "logs": self.logs, "errors": self.errors, "boots": list(self.boots),
+                "reboot_loop": self.reboot_loop, "online": self.online()}
+
+    @classmethod
+    def fromDict(cls, device, data):
+        state = cls(device)
+        for key in ("version", "platform", "first_seen", "last_login", "last_seen", "logins", "logs",
+                    "errors", "reboot_loop"):
+            if key in data:
+                setattr(state, key, data[key])
+        state.boots.extend(data.get("boots", []))
+        return state
+
+
+class Devices:
+    """ Table of the DeviceState of all known devices, only used from the event loop """
+
+    def __init__(self, path=None):
+        self.path = path  # snapshot file, None to keep the state only in memory
+        self._states = {}
+        self._dirty = False
+        metrics.register("devices_known", lambda: len(self._states))
+        metrics.register("devices_online", self.countOnline)
+        metrics.register("devices_reboot_loop", lambda: len(self.rebootLoops()))
+
+    def get(self, device):
+        return self._states.get(device)
+
+    def _state(self, device):
+        state = self._states.get(device)
+        if state is None:
+            state = self._states[device] = DeviceState(device)
+        return state
+
+    def login(self, device, version=None, platform=None):
+        """ Records a config request, returns True if the device just started a reboot loop """
+        state = self._state(device)
+        now = time.time()
+        state.version = version
+        state.platform = platform
+        state.last_login = state.last_seen = now
+        state.logins += 1
+        state.boots.append(now)
+        self._dirty = True
+        loop = len(state.boots) == REBOOT_LOOP_COUNT and now - state.boots[0] <= REBOOT_LOOP_WINDOW
+        if loop == state.reboot_loop:
+            return False
+        state.reboot_loop = loop
+        if loop:
+            log.warn("Device {!s} logged in {!s} times within {:.0f}s, reboot loop?".format(
+                device, REBOOT_LOOP_COUNT, now - state.boots[0]))
+        else:
+            log.info("Device {!s} is not in a reboot loop anymore".format(device))
+        return loop
+
+    def seen(self, device, level=None):
+        """ Records a log message of a device """
+        state = self._state(device)
+        state.last_seen = time.time()
+        state.logs += 1
+        if level in ERROR_LEVELS:
+            state.errors += 1
+        self._dirty = True
+
+    def countOnline(self):
+        now = time.time()
+        return sum(1 for state in list(self._states.values()) if state.online(now))
+
+    def rebootLoops(self):
+        return [state.id for state in list(self._states.values()) if state.reboot_loop]
+
+    def summary(self):
+        return {"known": len(self._states), "online": self.countOnline(), "reboot_loop": self.rebootLoops()}
+
+    def snapshot(self):
+        """ Returns the state of all devices as dict if it changed since the last snapshot, otherwise None """
+        if not self._dirty:
+            return None
+        self._dirty = False
+        return {device: state.toDict() for device, state in self._states.items()}
+
+    def save(self, snapshot):
+        """ Writes a snapshot to the file, blocking """
+        try:
+            with open(self.path + ".tmp", "w") as f:
+                json.dump(snapshot, f)
+            os.replace(self.path + ".tmp", self.path)
+        except (OSError, TypeError, ValueError) as e:
+            log.error("Could not write device states to {!s}: {!s}".format(self.path, e))
+
+    def load(self, pattern=None, select=None):
+        """
+        Loads the states saved in all files matching pattern (default the own file),
+        select(device) returns if a device belongs to this table. Blocking.
+        """
+        for path in sorted(glob.glob(pattern or self.path)):
+            try:
+                with open(path) as f:
+                    data = json.load(f)
+            except (OSError, ValueError) as e:
+                log.error("Could not load device states from {!s}: {!s}".format(path, e))
+                continue
+            for device, values in data.items():
+                if select is not None and not select(device):
+                    continue
+                state = self._states.get(device)
+                if state is None or state.last_seen < values.get("last_seen", 0):
+                    self._states[device] = DeviceState.fromDict(device, values)
+        log.debug("Loaded the state of {!s} devices".format(len(self._states)))
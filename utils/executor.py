@@ -0,0 +1,14 @@
+# Thread pool for blocking disk access (client directories, config files)
+# so a slow storage doesn't stall the event loop and the mqtt connection.
+
+import asyncio
+import concurrent.futures
+import config
+
+_executor = concurrent.futures.ThreadPoolExecutor(max_workers=getattr(config, "IO_THREADS", 4),
+                                                  thread_name_prefix="io")
+
+
+async def run(func, *args):
+    """ Runs a blocking function in the I/O thread pool and returns its result """
+    return await asyncio.get_event_loop().run_in_executor(_executor, func, *args)
@@ -6,27 +6,309 @@ Created on 25.03.2018
 
 import logging.handlers
 import os
+import queue
+import threading
+import atexit
+import time
+import datetime
+import gzip
+import re
+import shutil
+import concurrent.futures
 import config
+from utils import metrics
 
+try:
+    import zstandard
+    ZSTD_AVAILABLE = True
+except ImportError:
+    ZSTD_AVAILABLE = False
+
+BUFFER_SIZE = getattr(config, "LOG_BUFFER_SIZE", 64 * 1024)
+FLUSH_INTERVAL = getattr(config, "LOG_FLUSH_INTERVAL", 1)
+MAX_BYTES = getattr(config, "LOG_MAX_BYTES", 1024 * 1024)
+ROTATE_WHEN = getattr(config, "LOG_ROTATE_WHEN", "midnight")
+BACKUP_COUNT = getattr(config, "LOG_BACKUP_COUNT", 100)
+RETENTION_DAYS = getattr(config, "LOG_RETENTION_DAYS", 30)
+COMPRESSION = getattr(config, "LOG_COMPRESSION", "gzip")
+if COMPRESSION == "zstd" and not ZSTD_AVAILABLE:
+    COMPRESSION = "gzip"  # logged as soon as the handlers are set up
+
+EXTENSIONS = {"gzip": ".gz", "zstd": ".zst"}
+
+_dirty = {}  # BufferedRotatingFileHandler: time of the first unflushed record, only used by the LogWriter
+
+
+class _Close:
+    __slots__ = ("target",)
+
+    def __init__(self, target):
+        self.target = target
+
+
+class QueuedHandler(logging.handlers.QueueHandler):
+    """
+    Handler that only puts records into the log queue, the target handler
+    is called by the LogWriter thread so no file access happens on the event loop.
+    """
+
+    def __init__(self, target):
+        super().__init__(log_queue)
+        self.target = target
+        self.setLevel(target.level)
+
+    def prepare(self, record):
+        record = super().prepare(record)  # formats the message, target formatter adds the rest
+        record.target = self.target
+        return record
+
+    def close(self):
+        # target is closed by the writer thread after all its queued records got written
+        self.queue.put_nowait(_Close(self.target))
+        super().close()
+
+
+def _compress(path, compression):
+    with open(path, "rb") as src, open(path + ".tmp", "wb") as dst:
+        if compression == "zstd":
+            zstandard.ZstdCompressor().copy_stream(src, dst)
+        else:
+            with gzip.GzipFile(filename=os.path.basename(path), mode="wb", fileobj=dst) as gz:
+                shutil.copyfileobj(src, gz)
+    # segments are sorted and expired by their modification time
+    shutil.copystat(path, path + ".tmp")
+    os.rename(path + ".tmp", path + EXTENSIONS[compression])
+    os.remove(path)
+
+
+def _compact(filename, compression, backup_count, retention):
+    """
+    Runs in the compactor thread: compresses all rotated segments of a log file
+    (also ones left over by a previous run) and removes the oldest ones.
+    """
+    directory, base = os.path.split(filename)
+    pattern = re.compile(re.escape(base) + r"\.(\d{4}-\d{2}-\d{2}_\d{6}(-\d+)?|\d+)(\.gz|\.zst)?$")
+    segments = []
+    try:
+        for entry in os.scandir(directory or "."):
+            match = pattern.match(entry.name)
+            if match is None:
+                continue
+            path = entry.path
+            if compression and match.group(3) is None:
+                try:
+                    _compress(path, compression)
+                    path += EXTENSIONS[compression]
+                except Exception as e:
+                    print("LogCompactor: error compressing {!s}: {!s}".format(path, e))
+                    continue
+            segments.append((os.stat(path).st_mtime, path))
+        segments.sort(reverse=True)
+        oldest = time.time() - retention * 86400 if retention else None
+        for i, (mtime, path) in enumerate(segments):
+            if (backup_count and i >= backup_count) or (oldest is not None and mtime < oldest):
+                os.remove(path)
+    except Exception as e:
+        print("LogCompactor: error compacting {!s}: {!s}".format(filename, e))
+
+
+_compactor = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix="LogCompactor")
+
+
+class BufferedRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """
+    Log file handler keeping written records in a buffer instead of flushing every record.
+    The buffer is flushed if it exceeds buffer_size, on records of flush_level or above,
+    FLUSH_INTERVAL seconds after the first unflushed record (by the LogWriter) and on close.
+    The file size is counted instead of seeking to the end before every record.
+
+    The file is rotated when it exceeds maxBytes and/or at the interval when ("midnight" or seconds).
+    A rotated file is renamed to <filename>.<date>_<time> and compressed by a background thread,
+    which also removes segments beyond backupCount or older than retention days (0/None: no limit).
+    Must only be used by the LogWriter thread (wrapped in a QueuedHandler).
+    """
+
+    def __init__(self, filename, maxBytes=MAX_BYTES, backupCount=BACKUP_COUNT, when=ROTATE_WHEN,
+                 retention=RETENTION_DAYS, compression=COMPRESSION, buffer_size=BUFFER_SIZE,
+                 flush_level=logging.CRITICAL, **kwargs):
+        self.buffer_size = buffer_size
+        self.flush_level = flush_level
+        self.when = when
+        self.retention = retention
+        self.compression = compression
+        self._size = 0
+        self._pending = 0
+        super().__init__(filename, maxBytes=maxBytes, backupCount=backupCount, **kwargs)
+        try:
+            start = os.stat(self.baseFilename).st_mtime
+        except OSError:
+            start = time.time()
+        self._rollover_at = self._nextRollover(start)
+
+    def _nextRollover(self, now):
+        if not self.when:
+            return None
+        if self.when == "midnight":
+            day = datetime.date.fromtimestamp(now) + datetime.timedelta(days=1)
+            return datetime.datetime.combine(day, datetime.time()).timestamp()
+        return now + self.when
+
+    def _open(self):
+        stream = open(self.baseFilename, self.mode, buffering=self.buffer_size, encoding=self.encoding,
+                      errors=self.errors)
+        self._size = stream.seek(0, os.SEEK_END)
+        return stream
+
+    def shouldRollover(self, record):
+        # only called by the logging base class, emit checks the counted size itself
+        return False
+
+    def doRollover(self):
+        """ Renames the file instead of shifting all backups, compression runs in the background """
+        if self.stream is not None:
+            self.stream.close()  # flushes the buffer
+            self.stream = None
+        _dirty.pop(self, None)
+        self._pending = 0
+        self._rollover_at = self._nextRollover(time.time())
+        if self._size > 0:
+            name = "{!s}.{!s}".format(self.baseFilename, time.strftime("%Y-%m-%d_%H%M%S"))
+            dest, i = name, 0
+            while any(os.path.exists(dest + ext) for ext in ("", ".gz", ".zst")):
+                i += 1
+                dest = "{!s}-{!s}".format(name, i)
+            os.rename(self.baseFilename, dest)
+            try:
+                _compactor.submit(_compact, self.baseFilename, self.compression, self.backupCount,
+                                  self.retention)
+            except RuntimeError:
+                pass  # interpreter shutting down, segment gets compressed on the next rotation
+        if not self.delay:
+            self.stream = self._open()
+
+    def emit(self, record):
+        try:
+            msg = self.format(record) + self.terminator
+            if self.stream is None:
+                self.stream = self._open()
+            if self._size > 0 and ((0 < self.maxBytes <= self._size + len(msg)) or
+                                   (self._rollover_at is not None and record.created >= self._rollover_at)):
+                self.doRollover()
+                if self.stream is None:
+                    self.stream = self._open()
+            self.stream.write(msg)
+            self._size += len(msg)  # characters, approximately the bytes written
+            self._pending += len(msg)
+            if record.levelno >= self.flush_level or self._pending >= self.buffer_size:
+                self.flush()
+            elif self not in _dirty:
+                _dirty[self] = time.monotonic()
+        except RecursionError:
+            raise
+        except Exception:
+            self.handleError(record)
+
+    def flush(self):
+        super().flush()
+        self._pending = 0
+        _dirty.pop(self, None)
+
+    def close(self):
+        _dirty.pop(self, None)
+        super().close()
+
+
+def _flushDirty(now=None):
+    """ Flushes all buffered handlers whose oldest unflushed record is older than FLUSH_INTERVAL """
+    for handler, since in list(_dirty.items()):
+        if now is None or now - since >= FLUSH_INTERVAL:
+            try:
+                handler.flush()
+            except Exception as e:
+                print("LogWriter: error flushing log file: {!s}".format(e))
+                _dirty.pop(handler, None)
+
+
+class LogWriter(threading.Thread):
+    """ Background thread writing all queued records to their target handlers """
+
+    def __init__(self, log_queue):
+        super().__init__(name="LogWriter", daemon=True)
+        self._queue = log_queue
+
+    def run(self):
+        while True:
+            try:
+                items = [self._queue.get(timeout=FLUSH_INTERVAL)]
+            except queue.Empty:
+                _flushDirty(time.monotonic())
+                continue
+            # write everything that accumulated in one go
+            try:
+                while True:
+                    items.append(self._queue.get_nowait())
+            except queue.Empty:
+                pass
+            start = time.perf_counter()
+            for item in items:
+                if item is None:
+                    _flushDirty()
+                    return
+                self._handle(item)
+            metrics.observe("log_write_seconds", time.perf_counter() - start)
+            metrics.inc("log_records_total", len(items))
+            _flushDirty(time.monotonic())
+
+    def _handle(self, item):
+        try:
+            if type(item) == _Close:
+                item.target.close()
+            else:
+                item.target.handle(item)
+        except Exception as e:
+            print("LogWriter: error writing log record: {!s}".format(e))
+
+    def stop(self):
+        self._queue.put_nowait(None)
+        self.join()
+
+
+log_queue = queue.Queue()
+writer = LogWriter(log_queue)
+writer.start()
+metrics.register("log_queue_length", log_queue.qsize)
+atexit.register(writer.stop)
 
 # Set up a specific logger with our desired output level
 log = logging.getLogger(config.LOGGER_NAME)
-log.setLevel(logging.DEBUG)
 
 # Add the log message handler to the logger
 oslist = os.listdir(os.getcwd())
 if "Logs" not in oslist:
     os.mkdir("Logs")
-# handler = logging.handlers.TimedRotatingFileHandler(
-#    config.LOG_FOLDER + config.LOG_FILENAME, when="midnight")
-handler = logging.handlers.RotatingFileHandler(config.LOG_FOLDER + config.LOG_FILENAME,
-                                               maxBytes=1024 * 1024, backupCount=5)
+handler = BufferedRotatingFileHandler(config.LOG_FOLDER + config.LOG_FILENAME)
 clihandler = logging.StreamHandler()
-clihandler.setLevel(logging.DEBUG)
+clihandler.setLevel(getattr(config, "LOG_CONSOLE_LEVEL", logging.DEBUG))
 handler.setLevel(logging.INFO)
+# debug calls return before formatting anything if no handler wants debug records,
+# device loggers have their own level
+log.setLevel(min(handler.level, clihandler.level))
 formatter = logging.Formatter(
     '[%(asctime)s] [%(levelname)s] [%(name)s] [%(funcName)s] %(message)s')  # [%(module)s]
 handler.setFormatter(formatter)
 clihandler.setFormatter(formatter)
-log.addHandler(handler)
-log.addHandler(clihandler)
+log.addHandler(QueuedHandler(handler))
+log.addHandler(QueuedHandler(clihandler))
+if getattr(config, "LOG_COMPRESSION", "gzip") == "zstd" and not ZSTD_AVAILABLE:
+    logging.getLogger("Logging").warning("Library zstandard not available, compressing log files with gzip")
+
+
+def forwardTo(record_queue):
+    """
+    Sends all records reaching the main logger to another process (e.g. the front process
+    of the sharded mode) instead of writing them to the general log file and console.
+    """
+    for h in log.handlers[:]:
+        log.removeHandler(h)
+        h.close()
+    log.addHandler(logging.handlers.QueueHandler(record_queue))
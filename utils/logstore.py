@@ -0,0 +1,184 @@
+# Optional structured store of all device log messages in a SQLite database (WAL mode).
+# Messages are inserted in batches by a background thread, indexes on device, level and
+# time make queries like "all errors of garage* since yesterday" an index scan.
+# Messages older than the retention period are removed regularly.
+#
+# Query from the command line (does not need the server config):
+#   python -m utils.logstore --device "garage*" --level error --since 12h
+
+import argparse
+import logging
+import queue
+import sqlite3
+import threading
+import time
+import datetime
+
+log = logging.getLogger("LogStore")
+
+LEVELS = {"critical": logging.CRITICAL, "error": logging.ERROR, "warn": logging.WARNING,
+          "warning": logging.WARNING, "info": logging.INFO, "debug": logging.DEBUG}
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS logs (
+    ts REAL NOT NULL,
+    device TEXT NOT NULL,
+    level INTEGER NOT NULL,
+    message TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS logs_device ON logs (device, ts);
+CREATE INDEX IF NOT EXISTS logs_level ON logs (level, ts);
+CREATE INDEX IF NOT EXISTS logs_ts ON logs (ts);
+"""
+
+
+def _connect(path):
+    conn = sqlite3.connect(path)
+    # has to be set before WAL mode writes the header of a new database, no effect on existing ones
+    conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")  # durable at checkpoints, enough for logs
+    return conn
+
+
+class LogStore(threading.Thread):
+    """ Background thread inserting queued log messages into the database in batches """
+
+    def __init__(self, path, retention=30, batch_size=500, cleanup_interval=3600):
+        super().__init__(name="LogStore", daemon=True)
+        self.path = path
+        self.retention = retention  # days, None keeps all messages
+        self._batch_size = batch_size
+        self._cleanup_interval = cleanup_interval
+        self._queue = queue.Queue()
+        conn = _connect(path)
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            # database created without auto_vacuum, VACUUM rebuilds it once with the new setting
+            log.info("Enabling incremental vacuum for {!s}".format(path))
+            conn.execute("VACUUM")
+        with conn:
+            conn.executescript(_SCHEMA)
+        conn.close()
+
+    def add(self, device, level, message, ts=None):
+        """ Queues a message of a device, level is the name used in the log topic """
+        if type(message) != str:
+            message = message.decode(errors="replace") if type(message) == bytes else str(message)
+        self._queue.put_nowait((ts or time.time(), device, LEVELS.get(level, logging.INFO), message))
+
+    def qsize(self):
+        return self._queue.qsize()
+
+    def run(self):
+        conn = _connect(self.path)
+        cleaned = None
+        stop = False
+        while not stop:
+            try:
+                rows = [self._queue.get(timeout=self._cleanup_interval)]
+            except queue.Empty:
+                rows = []
+            try:
+                while len(rows) < self._batch_size:
+                    rows.append(self._queue.get_nowait())
+            except queue.Empty:
+                pass
+            if None in rows:
+                rows.remove(None)
+                stop = True
+            try:
+                if rows:
+                    with conn:
+                        conn.executemany("INSERT INTO logs VALUES (?, ?, ?, ?)", rows)
+                if self.retention and (cleaned is None or time.monotonic() - cleaned > self._cleanup_interval):
+                    cleaned = time.monotonic()
+                    self.cleanup(conn)
+            except Exception as e:
+                log.error("Error writing {!s} log messages to {!s}: {!s}".format(len(rows), self.path, e))
+        conn.close()
+
+    def cleanup(self, conn):
+        """ Removes messages older than the retention period and frees their pages """
+        with conn:
+            deleted = conn.execute("DELETE FROM logs WHERE ts < ?",
+                                   (time.time() - self.retention * 86400,)).rowcount
+        if deleted:
+            conn.execute("PRAGMA incremental_vacuum")
+            log.info("Removed {!s} log messages older than {!s} days".format(deleted, self.retention))
+
+    def stop(self):
+        """ Writes all queued messages and stops the thread """
+        self._queue.put_nowait(None)
+        self.join()
+
+    def query(self, **kwargs):
+        return query(self.path, **kwargs)
+
+
+def query(path, device=None, level=None, since=None, until=None, search=None, limit=100):
+    """
+    Returns a list of (ts, device, level name, message), newest first.
+    device can be a glob pattern like "garage*", level returns messages of that level and above,
+    since and until are unix timestamps, search is a substring of the message.
+    """
+    where = []
+    args = []
+    if device is not None:
+        where.append("device GLOB ?")
+        args.append(device)
+    if level is not None:
+        where.append("level >= ?")
+        args.append(LEVELS[level] if type(level) == str else level)
+    if since is not None:
+        where.append("ts >= ?")
+        args.append(since)
+    if until is not None:
+        where.append("ts < ?")
+        args.append(until)
+    if search is not None:
+        where.append("instr(message, ?) > 0")
+        args.append(search)
+    sql = "SELECT ts, device, level, message FROM logs"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY ts DESC"
+    if limit:
+        sql += " LIMIT {:d}".format(limit)
+    conn = sqlite3.connect("file:{!s}?mode=ro".format(path), uri=True)
+    try:
+        return [(ts, dev, logging.getLevelName(lvl).lower(), msg) for ts, dev, lvl, msg in conn.execute(sql, args)]
+    finally:
+        conn.close()
+
+
+def _parseTime(value):
+    """ Accepts relative times like 30m, 12h, 2d or a date like 2026-10-18 or 2026-10-18 20:00 """
+    units = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+    if value[-1:] in units and value[:-1].replace(".", "", 1).isdigit():
+        return time.time() - float(value[:-1]) * units[value[-1]]
+    for fmt in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%d"):
+        try:
+            return datetime.datetime.strptime(value, fmt).timestamp()
+        except ValueError:
+            pass
+    raise argparse.ArgumentTypeError("invalid time: {!r}".format(value))
+
+
+def _main():
+    parser = argparse.ArgumentParser(prog="python -m utils.logstore", description="Query the device log store")
+    parser.add_argument("--db", default="Logs/devices.db", help="database file (LOG_DB in config.py)")
+    parser.add_argument("--device", help="device name, glob patterns like 'garage*' are possible")
+    parser.add_argument("--level", choices=sorted(LEVELS), help="minimum log level")
+    parser.add_argument("--since", type=_parseTime, help="e.g. 12h, 2d or '2026-10-18 20:00'")
+    parser.add_argument("--until", type=_parseTime)
+    parser.add_argument("--grep", help="only messages containing this text")
+    parser.add_argument("--limit", type=int, default=100, help="0 for all messages")
+    args = parser.parse_args()
+    rows = query(args.db, args.device, args.level, args.since, args.until, args.grep, args.limit)
+    for ts, device, level, message in reversed(rows):
+        print("[{!s}] [{!s}] [{!s}] {!s}".format(
+            time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(ts)), level.upper(), device, message))
+
+
+if __name__ == "__main__":
+    _main()
@@ -0,0 +1,128 @@
+# Counters and timings of the hot paths. They can be scraped in the Prometheus
+# text format from a small HTTP endpoint and are published periodically by MQTTHandler.
+
+import asyncio
+import contextlib
+import logging
+import threading
+import time
+
+log = logging.getLogger("Metrics")
+
+PREFIX = "smartserver_"
+
+_lock = threading.Lock()  # metrics are also updated from the I/O and log writer threads
+_counters = {}  # (name, labels): value
+_timings = {}  # (name, labels): [count, sum, max]
+_callbacks = {}  # (name, labels): (type, function returning the current value)
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def inc(name, value=1, **labels):
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def observe(name, seconds, **labels):
+    key = _key(name, labels)
+    with _lock:
+        timing = _timings.get(key)
+        if timing is None:
+            _timings[key] = [1, seconds, seconds]
+        else:
+            timing[0] += 1
+            timing[1] += seconds
+            if seconds > timing[2]:
+                timing[2] = seconds
+
+
+@contextlib.contextmanager
+def timer(name, **labels):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+def register(name, func, mtype="gauge", **labels):
+    """ Registers a function returning the current value of a gauge or counter kept elsewhere """
+    _callbacks[_key(name, labels)] = (mtype, func)
+
+
+def _labels(labels, extra=None):
+    if extra:
+        labels = labels + (extra,)
+    if not labels:
+        return ""
+    return "{" + ",".join('{!s}="{!s}"'.format(k, str(v).replace('"', '\\"')) for k, v in labels) + "}"
+
+
+def _samples():
+    """ Yields (type, name, labels, value) of all metrics """
+    with _lock:
+        counters = list(_counters.items())
+        timings = [(key, list(value)) for key, value in _timings.items()]
+    for (name, labels), value in counters:
+        yield "counter", name, labels, value
+    for (name, labels), (count, total, maximum) in timings:
+        yield "summary", name + "_count", labels, count
+        yield "summary", name + "_sum", labels, total
+        yield "gauge", name + "_max", labels, maximum
+    for (name, labels), (mtype, func) in list(_callbacks.items()):
+        try:
+            value = func()
+        except Exception as e:
+            log.error("Error reading metric {!s}: {!s}".format(name, e))
+            continue
+        yield mtype, name, labels, value
+
+
+def collect():
+    """ Returns all metrics as dict, e.g. to publish them as json """
+    return {name + _labels(labels): value for mtype, name, labels, value in _samples()}
+
+
+def render():
+    """ Returns all metrics in the Prometheus text exposition format """
+    lines = []
+    typed = set()
+    for mtype, name, labels, value in _samples():
+        base = name[:-6] if mtype == "summary" and name.endswith("_count") else name
+        if mtype == "summary" and name.endswith("_sum"):
+            base = name[:-4]
+        if base not in typed:
+            typed.add(base)
+            lines.append("# TYPE {!s}{!s} {!s}".format(PREFIX, base, mtype))
+        lines.append("{!s}{!s}{!s} {!s}".format(PREFIX, name, _labels(labels), value))
+    return "\n".join(lines) + "\n"
+
+
+async def _handle(reader, writer):
+    try:
+        request = await reader.readline()
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass  # skip headers
+        if request.split(b" ")[1:2] in ([b"/metrics"], [b"/"]):
+            body = render().encode()
+            writer.write(b"HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n")
+        else:
+            body = b"not found\n"
+            writer.write(b"HTTP/1.0 404 Not Found\r\nContent-Type: text/plain\r\n")
+        writer.write("Content-Length: {!s}\r\n\r\n".format(len(body)).encode() + body)
+        await writer.drain()
+    except Exception as e:
+        log.debug("Error serving metrics: {!s}".format(e))
+    finally:
+        writer.close()
+
+
+async def serve(port, host="127.0.0.1"):
+    """ Starts the HTTP endpoint serving the metrics on /metrics """
+    server = await asyncio.start_server(_handle, host, port)
+    log.info("Serving metrics on http://{!s}:{!s}/metrics".format(host, port))
+    return server
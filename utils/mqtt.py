@@ -10,7 +10,7 @@ __version__ = "1.1"
 __updated__ = "2018-04-13"
 
 # changed version of MQTTHandler used in micropython pysmartnode
-# uses paho synchronous mqtt client and calling client.loop manually in coro
+# uses paho synchronous mqtt client with its socket registered in the asyncio event loop
 
 import json
 
@@ -18,95 +18,279 @@ import config
 import logging
 from paho.mqtt.client import Client as MQTTClient
 from paho.mqtt.client import connack_string
-from utils.tree import Tree
+from paho.mqtt.client import MQTT_ERR_NO_CONN
+from utils.topics import TopicMatcher
+from utils import metrics
 import asyncio
+import collections
+import socket
+import time
 
 log = logging.getLogger("MQTT")
 
 
+class _RateLimiter:
+    """ Token bucket for each topic, allows rate messages per second with bursts up to burst messages """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or rate
+        self._buckets = {}  # topic: [tokens, time of last update]
+
+    def allow(self, topic):
+        now = time.monotonic()
+        bucket = self._buckets.get(topic)
+        if bucket is None:
+            if len(self._buckets) >= 1024:
+                self._cleanup(now)
+            bucket = self._buckets[topic] = [self.burst, now]
+        else:
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+        if bucket[0] < 1:
+            return False
+        bucket[0] -= 1
+        return True
+
+    def _cleanup(self, now):
+        # buckets that would be full again are the same as no bucket
+        for topic in [t for t, b in self._buckets.items() if b[0] + (now - b[1]) * self.rate >= self.burst]:
+            del self._buckets[topic]
+
+
+def _raw(payload):
+    return payload  # bytes as received, not copied
+
+
+def _text(payload):
+    try:
+        return payload.decode()
+    except UnicodeDecodeError:
+        return payload  # binary payload, e.g. a compressed config
+
+
+_JSON_START = frozenset('{["-0123456789tfnNI \t\r\n')  # NaN and Infinity are accepted by json.loads
+
+
+def _json(payload):
+    msg = _text(payload)
+    # plain text can't be json, no need to let the parser fail on it
+    if type(msg) == str and msg[:1] in _JSON_START:
+        try:
+            return json.loads(msg)
+        except ValueError:
+            pass  # maybe not a json string, no way of knowing
+    return msg
+
+
+DECODERS = {"raw": _raw, "text": _text, "json": _json}
+
+
+class _Subscription:
+    __slots__ = ("callback", "decode")
+
+    def __init__(self, callback, decode):
+        self.callback = callback
+        self.decode = decode
+
+    def __eq__(self, other):
+        return type(other) == _Subscription and other.callback == self.callback and other.decode == self.decode
+
+    def __hash__(self):
+        return hash(self.callback)
+
+
 class MQTTHandler(MQTTClient):
-    def __init__(self, time_not_looping=0.05):
-        self._not_looping = time_not_looping
-        self._subscriptions = Tree(config.MQTT_HOME, ["Functions"])
+    def __init__(self, reconnect_interval=5, workers=None, queue_size=None, listen=True, id="SmartServer"):
+        """
+        listen: False doesn't subscribe topics at the broker, subscriptions only get the messages
+        passed to dispatch(), e.g. by the front process in the sharded mode
+        """
+        self._reconnect_interval = reconnect_interval
+        self._loop = asyncio.get_event_loop()
+        self._listen = listen
+        self._subscriptions = TopicMatcher()
+        self._routes = TopicMatcher()
+        self._rate_limits = TopicMatcher()
+        self._order_keys = TopicMatcher()
+        self._limited = set()  # topics currently dropped by their rate limit
+        # incoming messages are processed by a fixed number of workers, new messages
+        # are dropped if the queue is full so a message flood can't exhaust the memory.
+        # The queue holds (None, message) or (key, None) if messages with an order key are waiting
+        # in _ordered, so every key only occupies one worker and can't block the other keys.
+        self._queue = asyncio.Queue()
+        self._queue_size = queue_size or getattr(config, "MQTT_QUEUE_SIZE", 1000)
+        self._size = 0  # messages waiting, including the ones in _ordered
+        self._ordered = {}  # order key: deque of waiting messages, exists while the key is queued or processed
+        self._dropping = False
+        self._pending_acks = {}  # mid: Future resolved by the PUBACK
+        self.stats = {"received": 0, "processed": 0, "dropped": 0, "rate_limited": 0}
+        for state in self.stats:
+            metrics.register("mqtt_messages_total", lambda state=state: self.stats[state], "counter", state=state)
+        metrics.register("mqtt_queue_length", lambda: self._size)
+        self._stats_task = None
         self.payload_on = ("ON", True, "True")
         self.payload_off = ("OFF", False, "False")
-        self._retained = []
+        self._retained = {}  # topic: Event set as soon as its retained message got processed
+        self._retained_wildcards = {}  # prefix of a topic/# subscription: Event
         self.mqtt_home = config.MQTT_HOME
         super().__init__()
-        self.id = "SmartServer"
+        self.id = id
         self.enable_logger(log)
         self.username_pw_set(config.MQTT_USER, config.MQTT_PASSWORD)
         self.on_connect = self._connected
         self.on_message = self._execute_sync
-        self.on_disconnect = self._on_disconnect
-        self.connect(config.MQTT_HOST, 1883, 60)
+        self.on_publish = self._published
+        self.on_disconnect = self._disconnected
+        self.on_socket_open = self._socketOpened
+        self.on_socket_close = self._socketClosed
+        self.on_socket_register_write = self._registerWrite
+        self.on_socket_unregister_write = self._unregisterWrite
+        self.connect(config.MQTT_HOST, getattr(config, "MQTT_PORT", 1883), 60)
         asyncio.ensure_future(self._keep_connected())
+        for i in range(workers or getattr(config, "MQTT_WORKERS", 16)):
+            asyncio.ensure_future(self._worker())
 
     def _connected(self, client, userdata, flags, rc):
         log.info("Connection returned result: " + connack_string(rc))
         self._publishDeviceStats()
         self._subscribeTopics()
 
-    def _on_disconnect(self, client, userdata, rc):
+    def _disconnected(self, client, userdata, rc):
         if rc != 0:
             log.warn("Unexpected disconnection.")
 
+    def _socketOpened(self, client, userdata, sock):
+        # small packets waiting for each other's acknowledgement would be delayed by Nagle's algorithm
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._loop.add_reader(sock, self.loop_read)
+
+    def _socketClosed(self, client, userdata, sock):
+        self._loop.remove_reader(sock)
+
+    def _registerWrite(self, client, userdata, sock):
+        self._loop.add_writer(sock, self.loop_write)
+
+    def _unregisterWrite(self, client, userdata, sock):
+        self._loop.remove_writer(sock)
+
     async def _keep_connected(self):
+        """
+        Reading and writing is done by the event loop as soon as the socket is ready,
+        this only sends keepalive pings and reconnects if the connection got lost.
+        """
         log.info("Keeping connected")
         while True:
-            self.loop(0.05)
-            await asyncio.sleep(self._not_looping)
+            if self.loop_misc() == MQTT_ERR_NO_CONN:
+                try:
+                    self.reconnect()
+                except Exception as e:
+                    log.error("Reconnect failed: {!s}".format(e))
+                    await asyncio.sleep(self._reconnect_interval)
+                    continue
+            await asyncio.sleep(1)
 
     def _subscribeTopics(self):
-        for obj, topic in self._subscriptions.__iter__(with_path=True):
+        if not self._listen:
+            return
+        for topic in self._subscriptions:
             super().subscribe(topic, qos=1)
+        for topic in self._routes:
+            if topic not in self._subscriptions:
+                super().subscribe(topic, qos=1)
 
     def unsubscribe(self, topic, callback=None):
         if self._isDeviceTopic(topic):
             topic = self.getRealTopic(topic)
         if callback is None:
             log.debug("unsubscribing topic {}".format(topic))
-            self._subscriptions.removeObject(topic)
-            super().unsubscribe(topic)
-        else:
-            try:
-                cbs = self._subscriptions.getFunctions(topic)
-                if type(cbs) not in (tuple, list):
-                    self._subscriptions.removeObject(topic)
-                    return
-                try:
-                    cbs = list(cbs)
-                    cbs.remove(callback)
-                except ValueError:
-                    log.warn("Callback to topic {!s} not subscribed".format(topic), local_only=True)
-                    return
-                self._subscriptions.setFunctions(topic, cbs)
-            except ValueError:
-                log.warn("Topic {!s} does not exist".format(topic))
-
-    async def subscribe(self, topic, callback, qos=0, check_retained=True):
+        try:
+            if callback is None:
+                self._subscriptions.remove(topic)
+            else:
+                for subscription in self._subscriptions.get(topic):
+                    if subscription.callback == callback:
+                        self._subscriptions.remove(topic, subscription)
+                        break
+                else:
+                    raise ValueError(callback)
+        except KeyError:
+            log.warn("Topic {!s} does not exist".format(topic))
+            return
+        except ValueError:
+            log.warn("Callback to topic {!s} not subscribed".format(topic))
+            return
+        if topic not in self._subscriptions:
+            if topic in self._rate_limits:
+                self._rate_limits.remove(topic)
+            if topic in self._order_keys:
+                self._order_keys.remove(topic)
+            if self._listen and topic not in self._routes:
+                super().unsubscribe(topic)
+
+    async def subscribe(self, topic, callback, qos=0, check_retained=True, rate_limit=None, decode="json",
+                        order_by=None):
+        """
+        rate_limit: (messages per second, burst) allowed for each topic matching this subscription,
+        messages exceeding the limit are dropped before being queued
+        order_by: function returning a key for the topic of a message (e.g. the device id) or None,
+        messages with the same key are processed one after another in the order they arrived
+        decode: payload passed to the callback, "raw" bytes, "text" str or "json" for the decoded
+        json object if the payload is json, otherwise the str. Undecodable payloads are passed as bytes.
+        """
+        if decode not in DECODERS:
+            raise ValueError("Unsupported decode mode {!r}".format(decode))
         if self._isDeviceTopic(topic):
             topic = self.getRealTopic(topic)
         log.debug("Subscribing to topic {}".format(topic))
-        self._subscriptions.addObject(topic, callback)
+        subscription = _Subscription(callback, decode)
+        self._subscriptions.add(topic, subscription)
+        if rate_limit is not None:
+            self._rate_limits.add(topic, _RateLimiter(*rate_limit))
+        if order_by is not None:
+            self._order_keys.add(topic, order_by)
+        if not self._listen:
+            return
         if check_retained:
             if topic[-4:] == "/set":
                 # subscribe to topic without /set to get retained message for this topic state
                 # this is done additionally to the retained topic with /set in order to recreate
                 # the current state and then get new instructions in /set
                 state_topic = topic[:-4]
-                self._retained.append(state_topic)
-                self._subscriptions.addObject(state_topic, callback)
+                self._addRetained(state_topic)
+                self._subscriptions.add(state_topic, subscription)
                 super().subscribe(state_topic, qos)
                 await self._await_retained(state_topic, callback, True)
                 # to give retained state time to process before adding /set subscription
-            self._retained.append(topic)
+            self._addRetained(topic)
         super().subscribe(topic, qos)
         if check_retained:
             asyncio.ensure_future(self._await_retained(topic, callback))
 
+    def route(self, topic, router, qos=0, rate_limit=None):
+        """
+        Subscribes to a topic and passes its messages to router(topic, payload, retain) directly
+        from the network callback, without decoding or queueing them. Used by the front process
+        of the sharded mode, the router must not block.
+        """
+        if self._isDeviceTopic(topic):
+            topic = self.getRealTopic(topic)
+        log.debug("Routing topic {}".format(topic))
+        self._routes.add(topic, router)
+        if rate_limit is not None:
+            self._rate_limits.add(topic, _RateLimiter(*rate_limit))
+        super().subscribe(topic, qos)
+
     def _publishDeviceStats(self):
-        pass
+        interval = getattr(config, "STATS_INTERVAL", 60)
+        if self._stats_task is None and interval:
+            self._stats_task = asyncio.ensure_future(self._publishStats(interval))
+
+    async def _publishStats(self, interval):
+        while True:
+            if self.is_connected():
+                self.publish(self.getDeviceTopic("stats"), metrics.collect(), retain=True)
+            await asyncio.sleep(interval)
 
     def getDeviceTopic(self, attrib, is_request=False):
         if is_request:
@@ -123,53 +307,138 @@ class MQTTHandler(MQTTClient):
             raise ValueError("DeviceTopic does not start with .")
         return "{}/{}/{}".format(self.mqtt_home, self.id, device_topic[1:])
 
-    async def _await_retained(self, topic, cb=None, remove_after=False):
-        st = 0
-        while topic in self._retained and st <= 8:
-            await asyncio.sleep(0.1)
-            st += 1
-        try:
-            log.debug("removing retained topic {}".format(topic))
-            self._retained.remove(topic)
-        except ValueError:
-            pass
+    def _addRetained(self, topic):
+        if topic[-1:] == "#":
+            self._retained_wildcards[topic[:-1]] = asyncio.Event()
+        else:
+            self._retained[topic] = asyncio.Event()
+
+    def _isRetained(self, topic):
+        if topic in self._retained:
+            return True
+        if self._retained_wildcards:
+            # check every prefix of the topic, "" for a subscription to "#"
+            if "" in self._retained_wildcards:
+                return True
+            i = topic.find("/")
+            while i != -1:
+                if topic[:i + 1] in self._retained_wildcards:
+                    return True
+                i = topic.find("/", i + 1)
+        return False
+
+    async def _await_retained(self, topic, cb=None, remove_after=False, timeout=0.9):
+        """
+        Waits until the retained message of a topic got processed or the timeout passed.
+        Wildcard topics can receive multiple retained messages so they always wait for the timeout.
+        """
+        if topic[-1:] == "#":
+            retained, key = self._retained_wildcards, topic[:-1]
+        else:
+            retained, key = self._retained, topic
+        event = retained.get(key)
+        if event is not None:
+            try:
+                await asyncio.wait_for(event.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            if retained.get(key) is event:
+                log.debug("removing retained topic {}".format(topic))
+                del retained[key]
         if remove_after:
             self.unsubscribe(topic, cb)
 
     def _execute_sync(self, client, userdata, msg):
-        """mqtt library only handles sync callbacks so add it to async loop"""
-        asyncio.ensure_future(self._execute(msg.topic, msg.payload, msg.retain))
+        """mqtt library only handles sync callbacks so queue it for the async workers"""
+        self.stats["received"] += 1
+        topic = msg.topic
+        for limiter in self._rate_limits.match(topic):
+            if not limiter.allow(topic):
+                self.stats["rate_limited"] += 1
+                if topic not in self._limited:
+                    self._limited.add(topic)
+                    log.warn("Rate limit exceeded, dropping messages of topic {!s}".format(topic))
+                return
+        if self._limited:
+            self._limited.discard(topic)
+        routers = self._routes.match(topic)
+        if routers:
+            for router in routers:
+                try:
+                    router(topic, msg.payload, msg.retain)
+                except Exception as e:
+                    log.error("Error routing mqtt topic {!r}: {!s}".format(topic, e))
+            self.stats["processed"] += 1
+            return
+        self._enqueue(topic, msg.payload, msg.retain)
 
-    async def _execute(self, topic, msg, retain):
-        log.debug("mqtt execution: {!s} {!s}".format(topic, msg))
-        msg = msg.decode()
-        try:
-            msg = json.loads(msg)
-        except:
-            pass  # maybe not a json string, no way of knowing
-        cb = None
-        if topic in self._retained:
-            retain = True
+    def dispatch(self, topic, payload, retain=False):
+        """ Processes a message received by another process like it was received from the broker """
+        self.stats["received"] += 1
+        self._enqueue(topic, payload, retain)
+
+    def _enqueue(self, topic, payload, retain):
+        if self._size >= self._queue_size:
+            self.stats["dropped"] += 1
+            if not self._dropping:
+                self._dropping = True
+                log.error("Message queue full, dropping incoming messages")
+            return
+        self._dropping = False
+        self._size += 1
+        message = (topic, payload, retain, time.perf_counter())
+        order_by = self._order_keys.match(topic)
+        key = order_by[0](topic) if order_by else None
+        if key is None:
+            self._queue.put_nowait((None, message))
+            return
+        waiting = self._ordered.get(key)
+        if waiting is None:
+            self._ordered[key] = collections.deque((message,))
+            self._queue.put_nowait((key, None))
         else:
-            for topicR in self._retained:
-                if topicR[-1:] == "#":
-                    if topic.find(topicR[:-1]) != -1:
-                        retain = True
-        if retain:
-            try:
-                cb = self._subscriptions.getFunctions(topic + "/set")
-            except IndexError:
-                try:
-                    cb = self._subscriptions.getFunctions(topic)
-                except IndexError:
-                    pass
-        if cb is None:
+            waiting.append(message)  # key is already queued or being processed
+
+    async def _worker(self):
+        while True:
+            key, message = await self._queue.get()
+            if key is not None:
+                waiting = self._ordered[key]
+                message = waiting.popleft()
+            self._size -= 1
+            topic, msg, retain, queued = message
+            metrics.observe("mqtt_queue_wait_seconds", time.perf_counter() - queued)
             try:
-                cb = self._subscriptions.getFunctions(topic)
-            except IndexError:
+                await self._execute(topic, msg, retain)
+            except Exception as e:
+                log.error("Error processing mqtt topic {!r}: {!s}".format(topic, e))
+            self.stats["processed"] += 1
+            if key is not None:
+                if waiting:
+                    self._queue.put_nowait((key, None))  # other keys get their turn first
+                else:
+                    del self._ordered[key]
+
+    async def _execute(self, topic, payload, retain):
+        # formatted only if debug logging is enabled, this runs for every message
+        log.debug("mqtt execution: %s %s", topic, payload)
+        if self._isRetained(topic):
+            retain = True
+        cb = None
+        if retain:
+            cb = self._subscriptions.match(topic + "/set")
+        if not cb:
+            cb = self._subscriptions.match(topic)
+            if not cb:
                 log.warn("No cb found for topic {!s}".format(topic))
         if cb:
-            for callback in cb if (type(cb) == list or type(cb) == tuple) else [cb]:
+            decoded = {}  # payload decoded once for every decode mode of the subscriptions
+            for subscription in cb:
+                callback = subscription.callback
+                if subscription.decode not in decoded:
+                    decoded[subscription.decode] = DECODERS[subscription.decode](payload)
+                msg = decoded[subscription.decode]
+                start = time.perf_counter()
                 try:
                     if asyncio.iscoroutinefunction(callback):
                         res = await callback(topic=topic, msg=msg, retain=retain)
@@ -187,20 +456,43 @@ class MQTTHandler(MQTTClient):
                 except Exception as e:
                     log.error("Error executing {!s} mqtt topic {!r}: {!s}".format(
                         "retained " if retain else "", topic, e))
-            if retain and topic[-2:] != "/#":
-                # only remove if it is not a wildcard topic to allow other topics
-                # to handle retained messages belonging to this wildcard
-                try:
-                    self._retained.remove(topic)
-                except ValueError:
-                    pass
-                    # already removed by _await_retained
+                # partials and callable objects have no __name__
+                metrics.observe("mqtt_callback_seconds", time.perf_counter() - start,
+                                callback=getattr(callback, "__name__", repr(callback)))
+        if retain:
+            event = self._retained.pop(topic, None)
+            if event is not None:
+                event.set()  # wakes up _await_retained
 
     def publish(self, topic, msg, retain=False, qos=0):
         if type(msg) == dict or type(msg) == list:
             msg = json.dumps(msg)
-        elif type(msg) != str:
+        elif type(msg) not in (str, bytes, bytearray):
             msg = str(msg)
         if self._isDeviceTopic(topic):
             topic = self.getRealTopic(topic)
-        super().publish(topic, msg, retain=retain, qos=qos)
+        return super().publish(topic, msg, retain=retain, qos=qos)
+
+    async def publishAsync(self, topic, msg, retain=False, qos=1, timeout=10):
+        """
+        Publishes a message and waits until the broker acknowledged it (PUBACK for qos 1).
+        Returns False if no acknowledgement was received within the timeout.
+        """
+        info = self.publish(topic, msg, retain=retain, qos=qos)
+        if qos == 0 or info.is_published():
+            return True
+        future = self._loop.create_future()
+        self._pending_acks[info.mid] = future
+        try:
+            await asyncio.wait_for(future, timeout)
+            return True
+        except asyncio.TimeoutError:
+            log.warn("No acknowledgement for message to topic {!s}".format(topic))
+            return False
+        finally:
+            self._pending_acks.pop(info.mid, None)
+
+    def _published(self, client, userdata, mid):
+        future = self._pending_acks.get(mid)
+        if future is not None and not future.done():
+            future.set_result(True)
@@ -0,0 +1,124 @@
+# Sharded mode for large fleets.
+# The front process owns the MQTT subscriptions and forwards every message to one of
+# SHARDS worker processes, chosen by a hash of the device id. Each worker owns the Client
+# objects, log files and config cache of its devices and publishes its answers with its
+# own MQTT connection. Log records of the workers are written by the front process.
+
+import asyncio
+import logging
+import multiprocessing
+import queue
+import threading
+import zlib
+from utils import logging_config
+from utils import metrics
+
+log = logging.getLogger("Shards")
+
+
+def shardOf(device, count):
+    return zlib.crc32(device.encode()) % count
+
+
+class Front:
+    """ Starts the workers and forwards messages to them, batched per event loop iteration """
+
+    def __init__(self, count, target, queue_size=1000):
+        """ target(index, count, queue, log_queue) is the entry of a worker process """
+        self.count = count
+        self._target = target
+        self._queue_size = queue_size
+        # spawned workers don't inherit the event loop, threads and open files of this process
+        self._ctx = multiprocessing.get_context("spawn")
+        self._log_queue = self._ctx.Queue()
+        self._queues = [None] * count
+        self._processes = [None] * count
+        self._batches = [[] for _ in range(count)]
+        self._scheduled = False
+        self._dropping = False
+        self._loop = asyncio.get_event_loop()
+        self.dropped = 0
+        metrics.register("shard_dropped_total", lambda: self.dropped, "counter")
+        for i in range(count):
+            self._start(i)
+            metrics.register("shard_queue_length", lambda i=i: self._queues[i].qsize(), shard=i)
+        threading.Thread(target=self._receiveLogs, name="ShardLogs", daemon=True).start()
+
+    def _start(self, index):
+        self._queues[index] = self._ctx.Queue(self._queue_size)
+        process = self._ctx.Process(target=self._target, name="Shard{!s}".format(index), daemon=True,
+                                    args=(index, self.count, self._queues[index], self._log_queue))
+        process.start()
+        self._processes[index] = process
+        log.info("Started shard {!s} with pid {!s}".format(index, process.pid))
+
+    def send(self, device, item):
+        self.sendTo(shardOf(device, self.count), item)
+
+    def sendTo(self, index, item):
+        self._batches[index].append(item)
+        if not self._scheduled:
+            self._scheduled = True
+            self._loop.call_soon(self._flush)
+
+    def broadcast(self, item):
+        for i in range(self.count):
+            self.sendTo(i, item)
+
+    def _flush(self):
+        self._scheduled = False
+        for i, batch in enumerate(self._batches):
+            if not batch:
+                continue
+            self._batches[i] = []
+            try:
+                self._queues[i].put_nowait(batch)
+            except queue.Full:
+                self.dropped += len(batch)
+                if not self._dropping:
+                    self._dropping = True
+                    log.error("Queue of shard {!s} full, dropping messages".format(i))
+                continue
+            self._dropping = False
+
+    def check(self):
+        """ Restarts workers that exited """
+        for i, process in enumerate(self._processes):
+            if not process.is_alive():
+                log.error("Shard {!s} exited with code {!s}, restarting".format(i, process.exitcode))
+                self._start(i)
+
+    def _receiveLogs(self):
+        while True:
+            record = self._log_queue.get()
+            try:
+                logging_config.log.handle(record)
+            except Exception as e:
+                print("ShardLogs: error writing log record: {!s}".format(e))
+
+
+def receive(item_queue, handle):
+    """
+    Runs in a worker: passes every item sent by the front process to handle(item)
+    in the event loop of the calling thread.
+    """
+    loop = asyncio.get_event_loop()
+
+    def _handleBatch(batch):
+        for item in batch:
+            try:
+                handle(item)
+            except Exception as e:
+                log.error("Error handling {!s}: {!s}".format(item[:2], e))
+
+    def _run():
+        while True:
+            batch = item_queue.get()
+            loop.call_soon_threadsafe(_handleBatch, batch)
+
+    threading.Thread(target=_run, name="ShardReceiver", daemon=True).start()
+
+
+def frontAlive():
+    parent = multiprocessing.parent_process()
+    return parent is None or parent.is_alive()
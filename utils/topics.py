@@ -0,0 +1,132 @@
+# Subscription storage for MQTTHandler.
+# Topic filters are stored in a trie with a dict per level so matching a topic
+# costs O(topic depth). Results of matched topics are kept in a LRU cache
+# that is cleared whenever a subscription changes.
+
+import collections
+
+
+class _Node:
+    __slots__ = ("children", "values")
+
+    def __init__(self):
+        self.children = {}
+        self.values = None
+
+
+class TopicMatcher:
+    def __init__(self, cache_size=512, delimiter="/"):
+        self._root = _Node()
+        self._delimiter = delimiter
+        self._cache = collections.OrderedDict()
+        self._cache_size = cache_size
+
+    def add(self, topic_filter, value):
+        node = self._root
+        for level in topic_filter.split(self._delimiter):
+            child = node.children.get(level)
+            if child is None:
+                child = node.children[level] = _Node()
+            node = child
+        if node.values is None:
+            node.values = []
+        node.values.append(value)
+        self._cache.clear()
+
+    def remove(self, topic_filter, value=None):
+        """
+        Removes one value or all values (value=None) of a topic filter.
+        Raises KeyError if the filter does not exist, ValueError if the value is not subscribed.
+        """
+        path = [self._root]
+        levels = topic_filter.split(self._delimiter)
+        for level in levels:
+            node = path[-1].children.get(level)
+            if node is None:
+                raise KeyError(topic_filter)
+            path.append(node)
+        node = path[-1]
+        if node.values is None:
+            raise KeyError(topic_filter)
+        if value is None:
+            node.values = None
+        else:
+            node.values.remove(value)
+            if len(node.values) == 0:
+                node.values = None
+        # remove branches that have no subscriptions anymore
+        for i in range(len(levels), 0, -1):
+            node = path[i]
+            if node.values is not None or len(node.children) > 0:
+                break
+            del path[i - 1].children[levels[i - 1]]
+        self._cache.clear()
+
+    def get(self, topic_filter):
+        """ Returns the values of exactly this topic filter, raises KeyError if it does not exist """
+        node = self._root
+        for level in topic_filter.split(self._delimiter):
+            node = node.children.get(level)
+            if node is None:
+                raise KeyError(topic_filter)
+        if node.values is None:
+            raise KeyError(topic_filter)
+        return tuple(node.values)
+
+    def match(self, topic):
+        """ Returns a tuple of the values of all topic filters matching the topic (+ and # wildcards) """
+        values = self._cache.get(topic)
+        if values is not None:
+            self._cache.move_to_end(topic)
+            return values
+        found = []
+        self._match(self._root, topic.split(self._delimiter), 0, found)
+        values = tuple(found)
+        self._cache[topic] = values
+        if len(self._cache) > self._cache_size:
+            self._cache.popitem(last=False)
+        return values
+
+    @staticmethod
+    def _extend(found, values):
+        if values is not None:
+            for value in values:
+                if value not in found:
+                    found.append(value)
+
+    def _match(self, node, levels, i, found):
+        if i == len(levels):
+            self._extend(found, node.values)
+            child = node.children.get("#")  # "a/#" also matches "a"
+            if child is not None:
+                self._extend(found, child.values)
+            return
+        level = levels[i]
+        # topics starting with $ are not matched by wildcards on the first level
+        wildcards = i > 0 or level[:1] != "$"
+        child = node.children.get(level)
+        if child is not None:
+            self._match(child, levels, i + 1, found)
+        if wildcards:
+            child = node.children.get("+")
+            if child is not None:
+                self._match(child, levels, i + 1, found)
+            child = node.children.get("#")
+            if child is not None:
+                self._extend(found, child.values)
+
+    def __contains__(self, topic_filter):
+        try:
+            self.get(topic_filter)
+        except KeyError:
+            return False
+        return True
+
+    def __iter__(self, node=None, path=None):
+        """ Yields all subscribed topic filters """
+        node = node or self._root
+        for level, child in node.children.items():
+            topic = level if path is None else path + self._delimiter + level
+            if child.values is not None:
+                yield topic
+            yield from self.__iter__(child, topic)
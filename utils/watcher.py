@@ -0,0 +1,133 @@
+# Watches the Clients directory for changes of device configs and templates.
+# Uses inotify if the inotify_simple library is available, otherwise the config files
+# (including their templates) of the devices passed to setDevices() are polled.
+# Changes are debounced, the callback is called from the watcher thread with the set of
+# changed directory names in Clients (device names or "_templates").
+
+import logging
+import os
+import threading
+import time
+from utils import configs
+
+log = logging.getLogger("Watcher")
+try:
+    from inotify_simple import INotify, flags
+    INOTIFY_AVAILABLE = True
+except Exception:
+    log.debug("Library inotify_simple not available, polling config files")
+    INOTIFY_AVAILABLE = False
+
+CONFIG_FILES = ("config", "config.json", "config.hjson")  # names inside a device directory
+
+
+class Watcher(threading.Thread):
+    def __init__(self, callback, path=configs.CLIENTS_DIR, debounce=1, interval=2):
+        super().__init__(name="ConfigWatcher", daemon=True)
+        self._callback = callback
+        self._path = path
+        self._debounce = debounce
+        self._interval = interval  # polling interval if inotify is not available
+        self._stopped = False
+        self._devices = {}  # device name: signature of the files sent to it, polled if inotify is not available
+
+    def run(self):
+        if INOTIFY_AVAILABLE:
+            try:
+                self._inotify()
+                return
+            except OSError as e:
+                log.error("Could not use inotify, polling config files: {!s}".format(e))
+        self._poll()
+
+    def stop(self):
+        self._stopped = True
+
+    def setDevices(self, devices):
+        """ Sets the devices whose config files are polled as dict of name: configs.fileSignature() of the sent config """
+        self._devices = dict(devices)
+
+    def _fire(self, changed):
+        log.debug("Changed configs: {!s}".format(changed))
+        try:
+            self._callback(changed)
+        except Exception as e:
+            log.error("Error in config change callback: {!s}".format(e))
+
+    # polling
+
+    def _poll(self):
+        old = {}
+        pending = set()
+        changed_at = None
+        while not self._stopped:
+            time.sleep(self._interval)
+            devices = self._devices
+            # the signature of a device includes the templates it uses,
+            # new devices are compared to the files of the config they got
+            new = {name: configs.fileSignature(name) for name in devices}
+            changed = {name for name in new if old.get(name, devices[name]) != new[name]}
+            old = new
+            if changed:
+                pending |= changed
+                changed_at = time.monotonic()
+            elif pending and time.monotonic() - changed_at >= self._debounce:
+                self._fire(pending)
+                pending = set()
+
+    # inotify
+
+    def _inotify(self):
+        inotify = INotify()
+        mask = flags.CLOSE_WRITE | flags.CREATE | flags.DELETE | flags.MOVED_TO | flags.MOVED_FROM
+        watches = {}  # wd: (name in Clients or None for Clients itself, path)
+
+        def watch(path, name):
+            try:
+                watches[inotify.add_watch(path, mask)] = (name, path)
+            except OSError:
+                pass  # removed in the meantime
+
+        def watchDevice(name):
+            path = os.path.join(self._path, name)
+            watch(path, name)
+            for sub in (os.listdir(path) if name == configs.TEMPLATES_DIR else ["config"]):
+                if sub[:1] != "." and os.path.isdir(os.path.join(path, sub)):
+                    watch(os.path.join(path, sub), name)
+
+        watch(self._path, None)
+        for name in os.listdir(self._path):
+            if name[:1] != "." and os.path.isdir(os.path.join(self._path, name)):
+                watchDevice(name)
+        pending = set()
+        deadline = None
+        while not self._stopped:
+            timeout = None if deadline is None else max(0, deadline - time.monotonic())
+            events = inotify.read(timeout=1000 if timeout is None else int(timeout * 1000))
+            for event in events:
+                if event.wd not in watches or event.name[:1] == ".":
+                    continue  # e.g. the compiled config cache
+                name, path = watches[event.wd]
+                is_dir = event.mask & flags.ISDIR
+                if name is None:
+                    # directory in Clients created or renamed
+                    if is_dir and event.mask & (flags.CREATE | flags.MOVED_TO):
+                        watchDevice(event.name)
+                    pending.add(event.name)
+                elif path == os.path.join(self._path, name) and name != configs.TEMPLATES_DIR:
+                    # device directory, ignore log files
+                    if event.name in CONFIG_FILES:
+                        if is_dir and event.mask & (flags.CREATE | flags.MOVED_TO):
+                            watch(os.path.join(path, event.name), name)
+                        pending.add(name)
+                else:
+                    if is_dir and event.mask & (flags.CREATE | flags.MOVED_TO):
+                        watch(os.path.join(path, event.name), name)  # new template group
+                    pending.add(name)
+                deadline = time.monotonic() + self._debounce
+            if deadline is not None and time.monotonic() >= deadline:
+                if pending:
+                    self._fire(pending)
+                pending = set()
+                deadline = None
+        inotify.close()